@@ -1,45 +1,82 @@
-from src.utils import run_initial_subscription_check, format_date_to_iso
-from src.handlers import handle_subscription_update, handle_subscription_deletion
+from src.reconciliation import run_initial_subscription_check
+from src.handlers import handle_events, EVENT_HANDLERS
+from src.router import WebhookRouter
+from src.ratelimit import create_limiter
 from src.database import Database
+from src.ledger import EventLedger
+from src.stripe_api import setup_stripe, close_stripe
+from src.catalog import Catalog, catalog
+from src.worker import EventQueue
+from src.coalesce import EventCoalescer
+from src.resilience import CallPolicy, firestore_policy, circuit_stats, CIRCUIT_STATES
+from src.metrics import metrics, MetricsMiddleware
+from src.config import get_settings
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
+from fastapi.responses import JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
 from fastapi import FastAPI, Request, HTTPException
-from slowapi import Limiter
-from dotenv import load_dotenv
-from pprint import pprint
 
 import traceback
-import uvicorn
-import stripe
-import os
+import asyncio
 
+# Environment is parsed once, warm invocations reuse it
+settings = get_settings()
 
-load_dotenv()
-
-# Setup stripe api key
-stripe.api_key = os.getenv("LIVE_STRIPE_API_KEY")
+# Setup stripe api key, the shared async http client is created on first use
+setup_stripe(settings.stripe_api_key)
 
 
 # Initialize FastAPI app with lifespan event
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup event: run the initial subscription check
-    try:
-        await run_initial_subscription_check()
-        print("Initial subscription check completed successfully.")
-    except Exception as error:
-        print(f"Failed to run initial subscription check: {error}")
+    # In lazy mode the client, catalog and indexes are filled on first use
+    if not settings.lazy_init:
+        # Open the shared Firestore client before serving any requests
+        await get_db().open()
+
+        # Load prices and products so webhooks can read names without calling Stripe
+        try:
+            await catalog.warm()
+        except Exception as error:
+            print(f"Failed to warm the catalog cache: {error}")
+
+    # Optionally pre-fill the customer ID -> user index from a projected scan
+    if settings.warm_customer_index:
+        try:
+            await get_db().warm_customer_index()
+        except Exception as error:
+            print(f"Failed to warm the customer index: {error}")
+
+    # Startup event: run the initial subscription check in the background so
+    # requests are served straight away, the job lease keeps it to one instance
+    reconciliation = None
+    if settings.reconcile_on_startup:
+        reconciliation = asyncio.create_task(run_initial_subscription_check())
+
+    if event_queue is not None:
+        event_queue.start()
 
     # Yield control to FastAPI to serve requests
     yield
 
-    # Shutdown event (if needed for cleanup)
+    # Shutdown event: finish open bursts and queued events, then close the
+    # shared Firestore channels and Stripe http client
     print("Shutting down...")
+    if reconciliation is not None and not reconciliation.done():
+        # Cancelling saves a checkpoint, the next run resumes from it
+        reconciliation.cancel()
+        await asyncio.gather(reconciliation, return_exceptions=True)
+
+    await coalescer.stop()
+
+    if event_queue is not None:
+        await event_queue.stop()
+        print(f"Event queue drained: {event_queue.stats()}")
+
+    await get_db().close()
+    await close_stripe()
+    await limiter.backend.close()
 
 
 # Connect to Firebase
@@ -52,8 +89,27 @@ def get_db():
         db = Database()
     return db
 
-# Initialize Limiter
-limiter = Limiter(key_func=get_remote_address)
+
+# Processed Stripe events, used to skip duplicate deliveries
+ledger = None
+
+
+def get_ledger():
+    global ledger
+    if not ledger:
+        ledger = EventLedger(get_db())
+    return ledger
+
+
+def duplicate_event_response(event):
+    print(f"Duplicate event {event.id} ({event.type}), skipping")
+    return JSONResponse(
+        content={"message": "Event already processed", "event": event.id},
+        status_code=200,
+    )
+
+# Limits shared by every worker when a redis backend is configured
+limiter = create_limiter(settings)
 
 app = FastAPI(
     title="Flippify Payment API",
@@ -62,18 +118,6 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
-# Attach the limiter to the FastAPI app
-app.state.limiter = limiter
-
-# Add exception handler for rate limit exceeded errors
-async def ratelimit_error(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
-        status_code=429,
-        content={"detail": "Rate limit exceeded, please try again later."},
-    )
-
-app.add_exception_handler(RateLimitExceeded, ratelimit_error)
-
 # Setup CORS
 app.add_middleware(
     CORSMiddleware,
@@ -83,166 +127,238 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Trace webhooks for the /metrics endpoint and structured logs
+if metrics.enabled:
+    app.add_middleware(
+        MetricsMiddleware,
+        metrics=metrics,
+        paths={"/webhook", "/checkout-complete", "/subscription-update", "/catalog-update"},
+    )
+
 # ----------------------------------------------------------------- #
 # Endpoints which receive event messages from stripe                #
 # ----------------------------------------------------------------- #
 
 
+def rate_limited_response():
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Rate limit exceeded, please try again later."},
+    )
+
+
 @app.get("/")
-@limiter.limit("5/second")
 async def root(request: Request):
+    client_ip = request.client.host if request.client else None
+    if not await limiter.hit(f"root:{client_ip}", 5, 1):
+        return rate_limited_response()
+
     return {"name": "Flippify Payments API", "version": "1.0.0", "status": "running"}
 
 
-async def setup_endpoint(request: Request, secret: str):
-    try:
-        db = get_db()
-    except Exception as error:
-        print(error)
-        return JSONResponse(
-            content={"message": "Error in connecting to database"}, status_code=500
-        )
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
 
-    try:
-        event = None
-        payload = await request.body()
-        sig_header = request.headers.get("stripe-signature")
-    except Exception as error:
-        print("Failed header information", error)
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Failed header information",
-                "event": None,
-                "payload": str(await request.body()),
-                "sig_header": str(request.headers.get("stripe-signature")),
-            },
-        )
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    try:
-        endpoint_secret = os.getenv(secret)
-        event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
-    except ValueError as error:
-        # Invalid payload
-        print("Value error", error)
-        return JSONResponse(
-            content={
-                "message": "Failed to create event, Invalid Payload",
-                "error": str(error),
-            },
-            status_code=400,
-        )
-    except stripe.error.SignatureVerificationError as error:
-        print("SignatureVerificationError", error)
-        # Invalid signature
-        return JSONResponse(
-            content={
-                "message": "Failed to create event, Invalid Signature",
-                "error": str(error),
-            },
-            status_code=400,
-        )
-    except Exception as error:
-        print("Unknown", error)
-        return JSONResponse(
-            content={
-                "message": "Failed to create event, Exception",
-                "error": str(error),
-            },
-            status_code=500,
-        )
 
-    return event, db
+async def process_events(events):
+    db = get_db()
+    response = await handle_events(db, events)
 
+    # Only successful events are recorded, failures are left for Stripe to retry
+    if response is None or response.status_code < 300:
+        for event in events:
+            await get_ledger().mark_processed(event.id, event.type)
 
-@app.post("/checkout-complete")
-@limiter.limit("10/second")
-async def checkout_complete(request: Request):
-    try:
-        event, db = await setup_endpoint(request, "LIVE_CHECKOUT_COMPLETE_SECRET")
+    if settings.lazy_init:
+        await db.flush_referral_credits()
 
-        if event["type"] == "checkout.session.completed":
-            session_data = event["data"]["object"]
-            stripe_customer_id = session_data["customer"]
-            subscription_id = session_data["subscription"]
+    return response
 
-            subscription = stripe.Subscription.retrieve(subscription_id)
 
-            product_id = subscription["plan"]["product"]
-            price_id = subscription["plan"]["id"]
-            price = stripe.Price.retrieve(price_id)
-            name = price["nickname"]
+async def process_queued_events(events):
+    # Raise on a 5xx so the worker retries it, Stripe has already been answered
+    with metrics.webhook("queue") as trace:
+        metrics.tag(events[-1])
+        response = await process_events(events)
+        if trace is not None:
+            trace.status = 200 if response is None else response.status_code
 
-            data = {
-                "name": name,
-                "id": product_id,
-                "override": False,
-                "createdAt": format_date_to_iso(datetime.now(timezone.utc)),
-            }
+    if response is None or response.status_code < 300:
+        return
 
-            user_ref = await db.query_user_ref("stripeCustomerId", stripe_customer_id)
-            await db.add_subscriptions(user_ref, [data])
+    event_ids = ", ".join(event.id for event in events)
+    error = RuntimeError(f"Events {event_ids} failed with status {response.status_code}")
+    if response.status_code < 500:
+        # A 4xx such as an unknown user fails the same way on every retry,
+        # record it now rather than holding up the shard's other customers
+        await record_failed_events(events, error)
+        return
 
-        else:
-            print(f"Unhandled event type {event['type']}")
-            return JSONResponse(
-                content={"message": f"Unhandled event type {event['type']}"},
-                status_code=500,
-            )
+    raise error
 
-    except Exception as error:
-        print("An error occur in checkout_complete()", error)
-        print(traceback.format_exc())
+
+async def record_failed_events(events, error):
+    # Stripe was answered with a 202, so it won't redeliver these
+    for event in events:
+        print(f"Queued event {event.id} ({event.type}) failed: {error}")
+        await get_ledger().mark_failed(event.id, event.type, error)
+
+
+# Queue used in fast-ack mode, None when events are handled inline
+event_queue = None
+if settings.webhook_async_mode:
+    event_queue = EventQueue(
+        process_queued_events,
+        workers=settings.webhook_workers,
+        maxsize=settings.webhook_queue_size,
+        on_failure=record_failed_events,
+    )
+
+
+def enqueue_events(events):
+    # Bursts are keyed by customer so each customer's events stay in order
+    stripe_customer_id = events[0].object.customer
+    event_ids = [event.id for event in events]
+    if not event_queue.submit(stripe_customer_id, events):
+        print(f"Event queue full, rejected {event_ids}")
         return JSONResponse(
-            content={
-                "message": "Failed to update database for checkout",
-                "error": str(error),
-            },
-            status_code=500,
+            content={"message": "Event queue full, please retry later"},
+            status_code=503,
         )
 
-    return JSONResponse(content={"message": "Checkout complete"}, status_code=200)
+    return JSONResponse(
+        content={"message": "Event queued", "events": event_ids},
+        status_code=202,
+    )
 
 
-@app.post("/subscription-update")
-@limiter.limit("10/second")
-async def subscription_update(request: Request):
+async def dispatch_events(events):
+    # Called with one customer's events, ordered by when Stripe created them
+    if event_queue is not None:
+        return enqueue_events(events)
+
+    # Verified events are limited per customer, not per sending address
+    async with limiter.customer_slot(events[0].object.customer) as acquired:
+        if not acquired:
+            return rate_limited_response()
+
+        return await process_events(events)
+
+
+# With a window set, a customer's burst of events is handled as one
+coalescer = EventCoalescer(
+    dispatch_events,
+    window=settings.coalesce_window_ms / 1000,
+    max_events=settings.coalesce_max_events,
+)
+
+
+def dependency_unavailable_response(policy: CallPolicy):
+    # Stripe retries with backoff, which gives the dependency time to
+    # recover, Retry-After is when the circuit next lets a call through
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"{policy.name} is unavailable, please retry later"},
+        headers={"Retry-After": str(policy.breaker.retry_after())},
+    )
+
+
+def cache_stats() -> dict[str, dict]:
+    db = get_db()
+    return {
+        "catalog_prices": catalog.prices.stats(),
+        "customer_refs": db.customer_index_stats(),
+        "referrers": db.referral_stats()["referrers"],
+        "processed_events": get_ledger().stats(),
+    }
+
+
+def cache_gauge(field: str):
+    return lambda: [({"cache": name}, stats[field]) for name, stats in cache_stats().items()]
+
+
+def queue_gauge(field: str):
+    return lambda: event_queue.stats()[field] if event_queue is not None else 0
+
+
+# Gauges are read when /metrics is scraped, so they cost nothing per webhook
+metrics.gauge("payments_cache_entries", "Entries held in each in-process cache", cache_gauge("size"))
+metrics.gauge("payments_cache_hits", "Lookups answered by each cache", cache_gauge("hits"))
+metrics.gauge("payments_cache_misses", "Lookups each cache had to pass on", cache_gauge("misses"))
+metrics.gauge("payments_cache_evictions", "Entries evicted from each cache", cache_gauge("evictions"))
+metrics.gauge("payments_queue_depth", "Events waiting in the webhook queue", queue_gauge("depth"))
+metrics.gauge("payments_queue_max_depth", "Deepest the webhook queue has been", queue_gauge("max_depth"))
+metrics.gauge("payments_queue_rejected", "Events rejected by a full webhook queue", queue_gauge("rejected"))
+metrics.gauge("payments_queue_failed", "Queued events that failed", queue_gauge("failed"))
+metrics.gauge(
+    "payments_events_coalesced",
+    "Events handled as part of another event's burst",
+    lambda: coalescer.stats()["coalesced"],
+)
+metrics.gauge(
+    "payments_circuit_state",
+    "Circuit breaker of each dependency, 0 closed, 1 half open, 2 open",
+    lambda: [({"dependency": name}, CIRCUIT_STATES[stats["state"]]) for name, stats in circuit_stats().items()],
+)
+metrics.gauge(
+    "payments_circuit_trips",
+    "Times each dependency's circuit breaker has opened",
+    lambda: [({"dependency": name}, stats["trips"]) for name, stats in circuit_stats().items()],
+)
+metrics.gauge(
+    "payments_referral_credits_pending",
+    "Referral credits the last flush left unwritten",
+    lambda: get_db().referral_stats()["pending"],
+)
+
+
+async def handle_subscription_event(event):
     try:
-        event, db = await setup_endpoint(request, "LIVE_SUBSCRIPTION_UPDATE_SECRET")
-        subscription = event["data"]["object"]
-        stripe_customer_id = subscription["customer"]
-        plan = subscription["plan"]
-        product_id = plan["product"]
-        price_id = plan["id"]
-
-        if event["type"] == "customer.subscription.updated":
-            # This function handles when the user has upgraded or downgraded their subscription
-            return await handle_subscription_update(db, stripe_customer_id, price_id, product_id)
-
-        elif event["type"] == "customer.subscription.deleted":
-            return await handle_subscription_deletion(db, stripe_customer_id, product_id)
-
-        else:
-            print(f"Unhandled event type {event['type']}")
-            return JSONResponse(
-                content={"message": f"Unhandled event type {event['type']}"},
-                status_code=500,
-            )
+        # Shed load while Firestore is failing instead of tying up a worker
+        # on calls that would time out
+        if not firestore_policy.available():
+            return dependency_unavailable_response(firestore_policy)
+
+        if await get_ledger().seen(event.id):
+            return duplicate_event_response(event)
+
+        return await coalescer.submit(event.object.customer, event)
 
     except Exception as error:
-        print(f"An error occur in subscription_update: {error}")
+        print(f"An error occurred handling {event.type}: {error}")
         print(traceback.format_exc())
         return JSONResponse(
             content={
-                "message": "Failed to update database for subscription update",
+                "message": "Failed to update database for subscription event",
                 "error": str(error),
-                "function": "subscription_update",
             },
             status_code=500,
         )
 
-    return JSONResponse(content={"message": "Subscription Updated"}, status_code=200)
+
+async def handle_catalog_event(event):
+    # Drop the cached price or product so the next lookup fetches it again
+    catalog.invalidate(event)
+
+
+# Secrets are read once here, event types without a handler are acknowledged
+router = WebhookRouter(settings.webhook_secrets, limiter=limiter)
+router.register(list(EVENT_HANDLERS), handle_subscription_event)
+router.register(Catalog.EVENT_TYPES, handle_catalog_event)
+
+
+# One route per Stripe endpoint, they all verify against every secret
+@app.post("/webhook")
+@app.post("/checkout-complete")
+@app.post("/subscription-update")
+@app.post("/catalog-update")
+async def webhook(request: Request):
+    return await router.dispatch(request)
 
 
-# if __name__ == "__main__":
-# uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+# Self-hosted deployments run this app with `python server.py`, which
+# starts a gunicorn worker per core and drains them on shutdown
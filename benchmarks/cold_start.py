@@ -0,0 +1,98 @@
+"""Cold-start benchmark for the serverless deployment.
+
+Imports the app and runs its lifespan startup in fresh interpreters, the
+same work a new Vercel instance does before its first request, and exits
+non-zero if the median exceeds the budget or a heavy SDK is imported
+eagerly.
+
+    python benchmarks/cold_start.py --runs 5 --budget-ms 800
+"""
+
+# External Imports
+import subprocess
+import statistics
+import argparse
+import json
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SDKs that must only load on first use
+LAZY_MODULES = ["stripe", "grpc", "google.cloud.firestore_v1", "google.oauth2.service_account"]
+
+PROBE = """
+import asyncio, json, sys, time
+
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+async def startup():
+    async with app.lifespan(app.app):
+        pass
+
+asyncio.run(startup())
+finished = time.perf_counter()
+
+def loaded(name):
+    module = sys.modules.get(name)
+    return module is not None and type(module).__name__ != "_LazyModule"
+
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "startup_ms": (finished - imported) * 1000,
+    "eager": [name for name in %r if loaded(name)],
+}))
+""" % (LAZY_MODULES,)
+
+
+def measure() -> dict:
+    env = {
+        **os.environ,
+        "LAZY_INIT": "true",
+        "RECONCILE_ON_STARTUP": "false",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("COLD_START_BUDGET_MS", "800")))
+    args = parser.parse_args()
+
+    # The first run also compiles bytecode, leave it out of the numbers
+    measure()
+    samples = [measure() for _ in range(args.runs)]
+
+    totals = [sample["import_ms"] + sample["startup_ms"] for sample in samples]
+    median = statistics.median(totals)
+    eager = sorted({name for sample in samples for name in sample["eager"]})
+
+    print(f"import   median {statistics.median(s['import_ms'] for s in samples):8.1f} ms")
+    print(f"startup  median {statistics.median(s['startup_ms'] for s in samples):8.1f} ms")
+    print(f"total    median {median:8.1f} ms   (budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if median > args.budget_ms:
+        print(f"FAIL: cold start is over budget by {median - args.budget_ms:.1f} ms")
+        failed = True
+
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
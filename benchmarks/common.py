@@ -0,0 +1,86 @@
+"""Shared helpers for the benchmark scripts."""
+
+# External Imports
+import hashlib
+import hmac
+import json
+import math
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Metrics where a larger number is an improvement, everything else is a cost
+HIGHER_IS_BETTER = {"throughput", "users_per_second"}
+
+
+def sign_payload(payload: str, secret: str, timestamp: int | None = None) -> str:
+    """Build a ``Stripe-Signature`` header the way Stripe signs webhooks."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def print_table(rows: list[dict], columns: list[str]):
+    widths = {column: max(len(column), *(len(f"{row.get(column, '')}") for row in rows)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(f"{row.get(column, '')}".rjust(widths[column]) for column in columns))
+
+
+def compare_to_baseline(results: dict[str, dict], baseline_path: str, tolerance: float) -> list[str]:
+    """Return a line per metric that regressed by more than ``tolerance``."""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    regressions = []
+    for case, metrics in results.items():
+        for name, value in metrics.items():
+            expected = baseline.get(case, {}).get(name)
+            if not isinstance(expected, (int, float)) or not isinstance(value, (int, float)) or not expected:
+                continue
+
+            if name in HIGHER_IS_BETTER:
+                regressed = value < expected * (1 - tolerance)
+            else:
+                regressed = value > expected * (1 + tolerance)
+
+            if regressed:
+                regressions.append(f"{case} {name}: {value} (baseline {expected})")
+
+    return regressions
+
+
+def finish(results: dict[str, dict], save: str | None, baseline: str | None, tolerance: float):
+    """Save results and/or fail the process on regressions, for CI."""
+    if save:
+        with open(save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f"Results saved to {save}")
+
+    if baseline:
+        regressions = compare_to_baseline(results, baseline, tolerance)
+        if regressions:
+            print(f"Regressions beyond {tolerance:.0%} of {baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+        print(f"No regressions beyond {tolerance:.0%} of {baseline}")
+
+
+def add_report_arguments(parser):
+    parser.add_argument("--save", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON results to compare against, exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression as a fraction")
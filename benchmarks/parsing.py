@@ -0,0 +1,164 @@
+"""Microbenchmark of webhook verification and decoding.
+
+Compares ``stripe.Webhook.construct_event`` with ``src.events.parse_event``
+(using orjson when installed, and the standard library json) on a
+realistic ``customer.subscription.updated`` payload, reporting time and
+peak memory allocated per call.
+
+    python benchmarks/parsing.py --items 20 --number 2000
+"""
+
+# Local Imports
+from common import ROOT, sign_payload, print_table, finish, add_report_arguments
+
+# External Imports
+import tracemalloc
+import argparse
+import timeit
+import json
+
+from src.events import parse_event
+import src.events as events
+
+import stripe
+
+SECRET = "whsec_benchmark"
+
+
+def subscription_payload(items: int) -> str:
+    """A subscription event shaped like Stripe's, with ``items`` line items."""
+    price = {
+        "id": "price_pro",
+        "object": "price",
+        "active": True,
+        "billing_scheme": "per_unit",
+        "created": 1700000000,
+        "currency": "gbp",
+        "livemode": True,
+        "lookup_key": None,
+        "metadata": {"tier": "pro", "features": "analytics,exports,priority-support"},
+        "nickname": "pro - member",
+        "product": "prod_pro",
+        "recurring": {"interval": "month", "interval_count": 1, "usage_type": "licensed"},
+        "tax_behavior": "inclusive",
+        "type": "recurring",
+        "unit_amount": 1499,
+        "unit_amount_decimal": "1499",
+    }
+    subscription = {
+        "id": "sub_1PxYzABCDEF",
+        "object": "subscription",
+        "application": None,
+        "automatic_tax": {"enabled": True, "liability": {"type": "self"}},
+        "billing_cycle_anchor": 1700000000,
+        "cancel_at_period_end": False,
+        "collection_method": "charge_automatically",
+        "created": 1700000000,
+        "currency": "gbp",
+        "current_period_end": 1702592000,
+        "current_period_start": 1700000000,
+        "customer": "cus_0000001",
+        "default_payment_method": "pm_1PxYzABCDEF",
+        "discount": None,
+        "items": {
+            "object": "list",
+            "data": [
+                {
+                    "id": f"si_{index:010d}",
+                    "object": "subscription_item",
+                    "created": 1700000000,
+                    "metadata": {},
+                    "plan": {**price, "object": "plan", "amount": 1499, "interval": "month"},
+                    "price": price,
+                    "quantity": 1,
+                    "subscription": "sub_1PxYzABCDEF",
+                    "tax_rates": [],
+                }
+                for index in range(items)
+            ],
+            "has_more": False,
+            "total_count": items,
+            "url": "/v1/subscription_items?subscription=sub_1PxYzABCDEF",
+        },
+        "latest_invoice": "in_1PxYzABCDEF",
+        "livemode": True,
+        "metadata": {"userId": "user_0000001", "source": "web"},
+        "plan": {**price, "object": "plan", "amount": 1499, "interval": "month"},
+        "quantity": 1,
+        "start_date": 1700000000,
+        "status": "active",
+    }
+    return json.dumps(
+        {
+            "id": "evt_1PxYzABCDEF",
+            "object": "event",
+            "api_version": "2024-06-20",
+            "created": 1700000000,
+            "data": {
+                "object": subscription,
+                "previous_attributes": {"plan": {**price, "id": "price_standard", "nickname": "standard - member"}},
+            },
+            "livemode": True,
+            "pending_webhooks": 1,
+            "request": {"id": None, "idempotency_key": None},
+            "type": "customer.subscription.updated",
+        }
+    )
+
+
+def measure(name: str, call, number: int) -> dict:
+    call()
+
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = min(timeit.repeat(call, number=number, repeat=3))
+    return {
+        "parser": name,
+        "us_per_call": round(seconds / number * 1_000_000, 1),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook parsing microbenchmark")
+    parser.add_argument("--items", type=int, default=20, help="subscription items in the payload")
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing run")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    payload = subscription_payload(args.items)
+    body = payload.encode()
+    header = sign_payload(payload, SECRET)
+    print(f"Payload: {len(body) / 1024:.1f} KiB")
+
+    results = {
+        "construct_event": measure(
+            "stripe.Webhook.construct_event",
+            lambda: stripe.Webhook.construct_event(payload, header, SECRET),
+            args.number,
+        ),
+        "parse_event": measure(
+            f"parse_event ({events.json_loads.__module__})",
+            lambda: parse_event(body, header, [SECRET]),
+            args.number,
+        ),
+    }
+
+    # The fallback path for installs without orjson
+    fast_loads, events.json_loads = events.json_loads, json.loads
+    try:
+        results["parse_event_json"] = measure(
+            "parse_event (json)", lambda: parse_event(body, header, [SECRET]), args.number
+        )
+    finally:
+        events.json_loads = fast_loads
+
+    print_table(list(results.values()), ["parser", "us_per_call", "peak_kib"])
+    finish(results, args.save, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
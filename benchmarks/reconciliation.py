@@ -0,0 +1,98 @@
+"""Reconciliation benchmark against in-process Stripe and Firestore fakes.
+
+Runs ``run_initial_subscription_check`` over synthetic user bases and
+reports wall time, users per second and the external calls it made.
+
+    python benchmarks/reconciliation.py --users 1000 10000 100000
+    python benchmarks/reconciliation.py --baseline reconcile.json
+"""
+
+# Local Imports
+from common import ROOT, print_table, finish, add_report_arguments
+
+# External Imports
+import argparse
+import asyncio
+import time
+import os
+
+os.environ.update(
+    {
+        "RECONCILE_MODE": "full",
+        "METRICS_ENABLED": "false",
+    }
+)
+
+from fakes import Dataset, FakeStripe, FakeDatabase, FakeLease, Latency
+
+import src.reconciliation as reconciliation
+
+
+async def run_case(users: int, args) -> dict:
+    dataset = Dataset(users)
+    stripe_latency = Latency(args.stripe_ms)
+    firestore_latency = Latency(args.firestore_ms)
+    fake_stripe = FakeStripe(dataset, stripe_latency).install()
+
+    # run_initial_subscription_check builds its own Database and lease
+    class BenchDatabase(FakeDatabase):
+        def __init__(self):
+            super().__init__(dataset.users, firestore_latency)
+
+    originals = reconciliation.Database, reconciliation.JobLease
+    reconciliation.Database = BenchDatabase
+    reconciliation.JobLease = FakeLease
+    FakeLease.states.clear()
+
+    try:
+        started = time.perf_counter()
+        await reconciliation.run_initial_subscription_check()
+        elapsed = time.perf_counter() - started
+    finally:
+        reconciliation.Database, reconciliation.JobLease = originals
+        fake_stripe.uninstall()
+
+    stats = FakeLease.states["reconciliation"].get("lastRun")
+    if stats is None:
+        raise RuntimeError(f"Reconciliation of {users} users did not finish")
+
+    return {
+        "users": users,
+        "seconds": round(elapsed, 3),
+        "users_per_second": round(users / elapsed, 1),
+        "users_updated": stats.get("users_updated"),
+        "stripe_calls": stripe_latency.calls,
+        "firestore_calls": firestore_latency.calls,
+        "errors": stats.get("errors"),
+    }
+
+
+async def benchmark(args) -> dict[str, dict]:
+    settings = reconciliation.get_settings()
+    settings.reconcile_stripe_rate = args.stripe_rate
+
+    results = {}
+    for users in args.users:
+        results[f"users_{users}"] = await run_case(users, args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconciliation benchmark")
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--stripe-ms", type=float, default=40.0, help="simulated Stripe latency")
+    parser.add_argument("--firestore-ms", type=float, default=8.0, help="simulated Firestore latency")
+    parser.add_argument("--stripe-rate", type=float, default=100.0, help="Stripe requests per second")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    print_table(
+        list(results.values()),
+        ["users", "seconds", "users_per_second", "users_updated", "stripe_calls", "firestore_calls", "errors"],
+    )
+    finish(results, args.save, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
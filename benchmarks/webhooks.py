@@ -0,0 +1,178 @@
+"""Webhook load test against in-process Stripe and Firestore fakes.
+
+Sends correctly signed ``checkout.session.completed`` and
+``customer.subscription.updated`` events to the app through an in-process
+ASGI transport and reports throughput and p50/p95/p99 latency at each
+concurrency level, with the number of user writes committed.
+
+With ``--burst`` each customer gets a checkout followed by plan changes
+sent back to back, as Stripe does for one purchase, and ``--coalesce-ms``
+sets the window those bursts are collapsed in.
+
+    python benchmarks/webhooks.py --requests 2000 --concurrency 1 8 32 128
+    python benchmarks/webhooks.py --burst 3 --coalesce-ms 50 --concurrency 32
+    python benchmarks/webhooks.py --save bench.json
+    python benchmarks/webhooks.py --baseline bench.json --tolerance 0.25
+"""
+
+# Local Imports
+from common import ROOT, sign_payload, percentile, print_table, finish, add_report_arguments
+
+# External Imports
+import argparse
+import asyncio
+import random
+import json
+import time
+import os
+
+SECRET = "whsec_benchmark"
+
+os.environ.update(
+    {
+        "LIVE_CHECKOUT_COMPLETE_SECRET": SECRET,
+        "LIVE_SUBSCRIPTION_UPDATE_SECRET": SECRET,
+        "LAZY_INIT": "true",
+        "RECONCILE_ON_STARTUP": "false",
+        "WEBHOOK_ASYNC_MODE": "false",
+        "STRUCTURED_LOGS": "false",
+    }
+)
+
+from fakes import Dataset, FakeStripe, FakeDatabase, Latency
+
+import httpx
+import app
+
+
+def build_events(dataset: Dataset, count: int, seed: int, burst: int = 1) -> list[tuple[str, str]]:
+    """Return ``(path, payload)`` pairs, a mix of checkouts and plan changes.
+
+    With ``burst`` above 1 events come in runs for one customer, a checkout
+    then plan changes, each created a second after the last.
+    """
+    rng = random.Random(seed)
+    subscribed, members = dataset.subscribed_indexes(), dataset.member_indexes()
+    created = int(time.time())
+
+    events = []
+    for number in range(count):
+        position = number % burst if burst > 1 else number % 2
+        if burst > 1:
+            # Every event in a run goes to one member, so its plan changes apply
+            if position == 0:
+                index = rng.choice(members)
+        else:
+            # Plan changes only go to users with a member subscription to swap
+            index = rng.choice(subscribed if position == 0 else members)
+        customer_id = dataset.customers[index]
+
+        if position == 0:
+            path = "/checkout-complete"
+            event_type = "checkout.session.completed"
+            data = {"object": "checkout.session", "customer": customer_id, "subscription": f"sub_{index:07d}"}
+        else:
+            plan = rng.choice(["standard", "pro"])
+            path = "/subscription-update"
+            event_type = "customer.subscription.updated"
+            data = dataset.subscription(index, plan)
+
+        payload = json.dumps(
+            {
+                "id": f"evt_bench_{seed}_{number}",
+                "object": "event",
+                "type": event_type,
+                "created": created + position,
+                "data": {"object": data},
+            }
+        )
+        events.append((path, payload))
+
+    return events
+
+
+async def run_level(client: httpx.AsyncClient, events: list[tuple[str, str]], concurrency: int) -> dict:
+    queue = list(reversed(events))
+    latencies: list[float] = []
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        while queue:
+            path, payload = queue.pop()
+            # Signed at send time, as Stripe does, so the timestamp is fresh
+            headers = {"stripe-signature": sign_payload(payload, SECRET), "content-type": "application/json"}
+
+            started = time.perf_counter()
+            response = await client.post(path, content=payload, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 300:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def benchmark(args) -> dict[str, dict]:
+    dataset = Dataset(args.users)
+    fake_stripe = FakeStripe(dataset, Latency(args.stripe_ms)).install()
+
+    # Read by the coalescer each time a burst opens
+    app.coalescer.window = args.coalesce_ms / 1000
+
+    results = {}
+    try:
+        async with app.lifespan(app.app):
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for level, concurrency in enumerate(args.concurrency):
+                    # A fresh database per level keeps the caches and ledger comparable
+                    app.db = FakeDatabase(dataset.users, Latency(args.firestore_ms))
+                    app.ledger = None
+                    app.catalog.prices.clear()
+
+                    events = build_events(dataset, args.requests, seed=level, burst=args.burst)
+                    results[f"concurrency_{concurrency}"] = {
+                        "concurrency": concurrency,
+                        **await run_level(client, events, concurrency),
+                        "user_writes": app.db.client.commits,
+                    }
+    finally:
+        fake_stripe.uninstall()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook throughput and latency benchmark")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--stripe-ms", type=float, default=40.0, help="simulated Stripe latency")
+    parser.add_argument("--firestore-ms", type=float, default=8.0, help="simulated Firestore latency")
+    parser.add_argument("--burst", type=int, default=1, help="events sent back to back per customer")
+    parser.add_argument("--coalesce-ms", type=float, default=0.0, help="window bursts are collapsed in")
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    print_table(
+        list(results.values()),
+        ["concurrency", "requests", "failures", "throughput", "p50_ms", "p95_ms", "p99_ms", "user_writes"],
+    )
+    finish(results, args.save, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
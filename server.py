@@ -0,0 +1,93 @@
+"""Production entry point for self-hosting the API.
+
+Runs ``app:app`` under gunicorn with one uvicorn worker per CPU core (or
+WEB_CONCURRENCY), on uvloop and the httptools parser. With SERVER_PRELOAD
+the app and the lazily imported Stripe and Firestore SDKs are loaded once
+in the master and forked, which works because their clients are only
+created inside each worker.
+
+On SIGTERM each worker stops accepting connections, gives in-flight
+requests SERVER_DRAIN_TIMEOUT seconds to finish, then runs the lifespan
+shutdown, which handles open event bursts, drains the event queue and
+closes the clients.
+
+    python server.py
+    python server.py --workers 4 --port 8080
+"""
+
+# Local Imports
+from src.config import get_settings
+from src.lazy import load_all
+
+# External Imports
+from gunicorn.app.base import BaseApplication
+from uvicorn_worker import UvicornWorker
+
+import argparse
+import os
+
+settings = get_settings()
+
+# Time for the lifespan shutdown once requests have drained, before the
+# master kills the worker
+SHUTDOWN_MARGIN = 15
+
+
+class ProductionWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+        "lifespan": "on",
+        "timeout_graceful_shutdown": settings.server_drain_timeout,
+    }
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+
+        # The SDKs are imported lazily, load them here so preloading shares
+        # them with every worker instead of each worker importing its own
+        if self.cfg.preload_app:
+            load_all()
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the payments API with gunicorn and uvicorn workers")
+    parser.add_argument("--host", default=settings.server_host)
+    parser.add_argument("--port", type=int, default=settings.server_port)
+    parser.add_argument("--workers", type=int, default=settings.server_workers, help="0 runs one per CPU core")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and settings.rate_limit_backend != "redis":
+        # Each worker would keep its own per-customer slots and counters
+        print("Running several workers with the memory rate limiter, set RATE_LIMIT_BACKEND=redis to share limits")
+
+    ProductionServer(
+        {
+            "bind": f"{args.host}:{args.port}",
+            "workers": workers,
+            "worker_class": ProductionWorker,
+            "preload_app": settings.server_preload,
+            "keepalive": settings.server_keepalive,
+            "graceful_timeout": settings.server_drain_timeout + SHUTDOWN_MARGIN,
+            "max_requests": settings.server_max_requests,
+            "max_requests_jitter": settings.server_max_requests // 10,
+            "forwarded_allow_ips": settings.forwarded_allow_ips,
+            "accesslog": "-",
+        }
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+# Local Imports
+from src.stripe_api import retrieve_price, list_prices
+from src.cache import TTLCache
+
+# External Imports
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.events import EventView
+    import stripe
+
+
+class Catalog():
+    """In-process cache of Stripe prices.
+
+    Warmed at startup, entries expire after ``ttl`` seconds and are dropped
+    as soon as a ``price.*`` webhook arrives for them.
+    """
+
+    # Webhook events that invalidate a cached entry
+    EVENT_TYPES = [
+        "price.created",
+        "price.updated",
+        "price.deleted",
+    ]
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.prices = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def warm(self):
+        async for price in list_prices():
+            self.prices.set(price["id"], price)
+
+    async def get_price(self, price_id: str) -> stripe.Price:
+        price = self.prices.get(price_id)
+        if price is None:
+            price = await retrieve_price(price_id)
+            self.prices.set(price_id, price)
+        return price
+
+    def invalidate(self, event: EventView) -> bool:
+        object_type = event.type.split(".")[0]
+        object_id = event.object.id
+
+        if object_type != "price":
+            return False
+
+        self.prices.pop(object_id)
+        return True
+
+
+catalog = Catalog()
@@ -0,0 +1,106 @@
+# Local Imports
+
+
+# External Imports
+from typing import Any, Awaitable, Callable
+
+import asyncio
+
+
+class EventCoalescer():
+    """Collects each customer's events for a short window and handles them together.
+
+    The first event for a key opens a window of ``window`` seconds, events
+    for the same key that arrive in it join the burst. When the window
+    closes (or ``max_events`` have joined) the handler is called once with
+    the burst, ordered by the events' ``created`` timestamps, and every
+    submitter is given its result.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list], Awaitable[Any]],
+        window: float = 0.05,
+        max_events: int = 20,
+    ):
+        self.handler = handler
+        self.window = window
+        self.max_events = max(1, max_events)
+
+        self._pending: dict[str, tuple[list, asyncio.Future, asyncio.TimerHandle]] = {}
+        self._flushing: set[asyncio.Task] = set()
+
+        self.events = 0
+        self.bursts = 0
+        self.max_burst = 0
+
+    async def submit(self, key: str | None, event) -> Any:
+        """Add an event to its key's burst, returns the handler's result for it."""
+        if key is None or self.window <= 0:
+            return await self.handler([event])
+
+        loop = asyncio.get_running_loop()
+        entry = self._pending.get(key)
+        if entry is None:
+            timer = loop.call_later(self.window, self._flush, key)
+            entry = self._pending[key] = ([], loop.create_future(), timer)
+
+        events, future, _ = entry
+        events.append(event)
+        if len(events) >= self.max_events:
+            self._flush(key)
+
+        # Shielded so one cancelled request doesn't cancel the whole burst
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _order(events: list) -> list:
+        # Redeliveries within the window are dropped, sorted() is stable so
+        # events created in the same second keep their arrival order
+        unique = list({event.id: event for event in reversed(events)}.values())[::-1]
+        return sorted(unique, key=lambda event: event.created or 0)
+
+    def _flush(self, key: str):
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+
+        events, future, timer = entry
+        timer.cancel()
+
+        task = asyncio.create_task(self._run(self._order(events), future))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _run(self, events: list, future: asyncio.Future):
+        self.events += len(events)
+        self.bursts += 1
+        self.max_burst = max(self.max_burst, len(events))
+
+        try:
+            result = await self.handler(events)
+        except Exception as error:
+            # Logged with its traceback by each submitter
+            print(f"An error occurred handling a burst of {len(events)} events: {error}")
+            future.set_exception(error)
+            # Marked as retrieved, submitters that were cancelled never will
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def stop(self):
+        """Handle every open burst straight away and wait for them."""
+        for key in list(self._pending):
+            self._flush(key)
+
+        await asyncio.gather(*self._flushing, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": round(self.window * 1000),
+            "open": len(self._pending),
+            "events": self.events,
+            "bursts": self.bursts,
+            "coalesced": self.events - self.bursts,
+            "max_burst": self.max_burst,
+        }
@@ -0,0 +1,118 @@
+# Local Imports
+
+
+# External Imports
+from dotenv import load_dotenv
+from functools import cache
+
+import os
+
+
+def _flag(name: str, default: bool = False) -> bool:
+    return os.getenv(name, str(default)).lower() == "true"
+
+
+class Settings():
+    """Environment configuration, parsed once per process."""
+
+    def __init__(self):
+        load_dotenv()
+
+        # Stripe
+        self.stripe_api_key = os.getenv("LIVE_STRIPE_API_KEY")
+
+        # Signing secrets of every webhook endpoint, a variable can hold
+        # several comma-separated secrets while one is being rolled
+        self.webhook_secrets = list(dict.fromkeys(
+            secret.strip()
+            for name in (
+                "LIVE_WEBHOOK_SECRETS",
+                "LIVE_CHECKOUT_COMPLETE_SECRET",
+                "LIVE_SUBSCRIPTION_UPDATE_SECRET",
+                "LIVE_CATALOG_UPDATE_SECRET",
+            )
+            for secret in (os.getenv(name) or "").split(",")
+            if secret.strip()
+        ))
+
+        # Firebase service account
+        self.firebase_project_id = os.getenv("FIREBASE_PROJECT_ID")
+        self.firebase_private_key_id = os.getenv("FIREBASE_PRIVATE_KEY_ID")
+        self.firebase_private_key = (os.getenv("FIREBASE_PRIVATE_KEY") or "").replace("\\n", "\n")
+        self.firebase_client_email = os.getenv("FIREBASE_CLIENT_EMAIL")
+        self.firebase_client_id = os.getenv("FIREBASE_CLIENT_ID")
+        self.firebase_client_x509_cert_url = os.getenv("FIREBASE_CLIENT_X509_CERT_URL")
+        self.firebase_project_url = os.getenv("FIREBASE_PROJECT_URL")
+
+        # Lazy mode skips startup warm-ups so serverless cold starts only pay
+        # for what a request uses; on by default when deployed on Vercel
+        self.lazy_init = _flag("LAZY_INIT", default=bool(os.getenv("VERCEL")))
+
+        # Webhook processing
+        self.webhook_async_mode = _flag("WEBHOOK_ASYNC_MODE")
+        self.webhook_workers = int(os.getenv("WEBHOOK_WORKERS", "4"))
+        self.webhook_queue_size = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+        self.warm_customer_index = _flag("WARM_CUSTOMER_INDEX")
+        # Seconds a customer ID -> user mapping is cached. Stripe customers
+        # are linked to users by another service, so a re-link is only seen
+        # when its entry expires
+        self.customer_ref_ttl = float(os.getenv("CUSTOMER_REF_TTL", "300"))
+
+        # Hold a customer's events this long and apply the burst in one
+        # write, 0 handles every event on its own
+        self.coalesce_window_ms = int(os.getenv("COALESCE_WINDOW_MS", "0"))
+        self.coalesce_max_events = int(os.getenv("COALESCE_MAX_EVENTS", "20"))
+
+        # Storage of user subscriptions, "array" or "map" (keyed by product
+        # ID). Run `python -m src.migrations --to map` before switching to map
+        self.subscription_layout = os.getenv("SUBSCRIPTION_LAYOUT", "array")
+
+        # Rate limiting, "memory" is per process, "redis" is shared by every
+        # worker and instance
+        self.rate_limit_backend = os.getenv("RATE_LIMIT_BACKEND", "memory")
+        self.rate_limit_redis_url = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+        self.webhook_customer_concurrency = int(os.getenv("WEBHOOK_CUSTOMER_CONCURRENCY", "1"))
+        self.invalid_signature_limit = int(os.getenv("INVALID_SIGNATURE_LIMIT", "20"))
+
+        # Calls to Stripe and Firestore: each attempt has a timeout and all
+        # attempts share a deadline, only idempotent calls are retried
+        self.stripe_timeout = float(os.getenv("STRIPE_TIMEOUT", "10"))
+        self.stripe_deadline = float(os.getenv("STRIPE_DEADLINE", "20"))
+        self.firestore_timeout = float(os.getenv("FIRESTORE_TIMEOUT", "5"))
+        self.firestore_deadline = float(os.getenv("FIRESTORE_DEADLINE", "10"))
+        self.dependency_retries = int(os.getenv("DEPENDENCY_RETRIES", "2"))
+
+        # A dependency's circuit opens after this many failed calls in a row
+        # and lets a trial call through once the reset time has passed
+        self.circuit_failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.circuit_reset_seconds = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+        # Reconciliation
+        self.reconcile_on_startup = _flag("RECONCILE_ON_STARTUP", default=not self.lazy_init)
+        self.reconcile_mode = os.getenv("RECONCILE_MODE", "incremental")
+        self.reconcile_concurrency = int(os.getenv("RECONCILE_CONCURRENCY", "16"))
+        self.reconcile_stripe_rate = float(os.getenv("RECONCILE_STRIPE_RATE", "20"))
+
+        # Self-hosted server (python server.py), 0 workers runs one per CPU core
+        self.server_host = os.getenv("HOST", "0.0.0.0")
+        self.server_port = int(os.getenv("PORT", "8000"))
+        self.server_workers = int(os.getenv("WEB_CONCURRENCY", "0"))
+        self.server_preload = _flag("SERVER_PRELOAD", default=True)
+        # Keep idle connections open longer than the load balancer does, or
+        # it may reuse a connection the server is closing
+        self.server_keepalive = int(os.getenv("SERVER_KEEPALIVE", "75"))
+        # Seconds in-flight requests get to finish on shutdown, queued events
+        # and the clients are closed after that
+        self.server_drain_timeout = int(os.getenv("SERVER_DRAIN_TIMEOUT", "20"))
+        self.server_max_requests = int(os.getenv("SERVER_MAX_REQUESTS", "0"))
+        # Proxies trusted to set X-Forwarded-For, so limits see the real client
+        self.forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+        # Instrumentation, served on /metrics and logged per webhook
+        self.metrics_enabled = _flag("METRICS_ENABLED", default=True)
+        self.structured_logs = _flag("STRUCTURED_LOGS", default=self.metrics_enabled)
+
+
+@cache
+def get_settings() -> Settings:
+    return Settings()
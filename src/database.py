@@ -1,178 +1,684 @@
-# Local Imports
+from __future__ import annotations
 
+# Local Imports
+from src.exceptions import UserNotFoundError
+from src.referrals import ReferralCredits
+from src.subscriptions import (
+    MAP,
+    layout_of,
+    member_subscription,
+    subscribed_name,
+    subscription_list,
+    subscription_path,
+)
+from src.config import get_settings
+from src.resilience import firestore_policy
+from src.metrics import metrics
+from src.cache import TTLCache
+from src.lazy import lazy_import
 
 # External Imports
-from google.cloud.firestore_v1.async_client import AsyncClient
-from google.cloud.firestore_v1 import AsyncDocumentReference, DocumentReference
-from google.oauth2 import service_account
-from google.cloud import firestore
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING, Any
+
+import asyncio
+import random
 
-import traceback
-import os
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1 import AsyncClient, AsyncDocumentReference
 
-load_dotenv()
+# Loaded on first use to keep them out of cold-start import time
+service_account = lazy_import("google.oauth2.service_account")
+firestore = lazy_import("google.cloud.firestore")
+api_exceptions = lazy_import("google.api_core.exceptions")
+
+# Same as FieldPath.document_id(), without importing firestore
+DOCUMENT_ID = "__name__"
 
 
 class Database():
-    # Class-level attributes for environment variables
-    FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")
-    FIREBASE_PRIVATE_KEY_ID = os.getenv("FIREBASE_PRIVATE_KEY_ID")
-    FIREBASE_PRIVATE_KEY = os.getenv("FIREBASE_PRIVATE_KEY").replace("\\n", "\n")
-    FIREBASE_CLIENT_EMAIL = os.getenv("FIREBASE_CLIENT_EMAIL")
-    FIREBASE_CLIENT_ID = os.getenv("FIREBASE_CLIENT_ID")
-    FIREBASE_CLIENT_X509_CERT_URL = os.getenv("FIREBASE_CLIENT_X509_CERT_URL")
-    FIREBASE_PROJECT_URL = os.getenv("FIREBASE_PROJECT_URL")
-
-    # A flag to track initialization
-    _initialized = False
+    # Credentials are built on first use, then shared
     _firebase_credentials = None 
 
+    # One client per process, its gRPC channels are reused by every call
+    _client: AsyncClient | None = None
+
+    # Stripe customer ID -> user document reference, skips the users query
+    # for repeat events from the same customer. This service never writes
+    # stripeCustomerId, so a customer re-linked to another user elsewhere
+    # is only picked up once the entry expires, keep CUSTOMER_REF_TTL short
+    _customer_refs = TTLCache(maxsize=10_000, ttl=get_settings().customer_ref_ttl)
+
+    # Firestore's limit on writes in one batch commit
+    MAX_BATCH_WRITES = 500
+
+    # What the webhook transactions read of a user
+    SUBSCRIPTION_FIELDS = ["id", "subscriptions", "referral.referredBy"]
+
+    # Result of a bulk change whose user was updated after it was read
+    STALE_WRITE = "The user changed since it was read"
+
+    # Deferred referral crediting, shared by every Database instance
+    _referral_credits: ReferralCredits | None = None
+
     def __init__(self):
-        if not Database._initialized:
+        if Database._referral_credits is None:
+            Database._referral_credits = ReferralCredits(self)
+
+    @staticmethod
+    def _credentials():
+        if Database._firebase_credentials is None:
+            settings = get_settings()
             # Credentials for service account
             Database._firebase_credentials = service_account.Credentials.from_service_account_info(
                 {
                     "type": "service_account",
-                    "project_id": Database.FIREBASE_PROJECT_ID,
-                    "private_key_id": Database.FIREBASE_PRIVATE_KEY_ID,
-                    "private_key": Database.FIREBASE_PRIVATE_KEY,
-                    "client_email": Database.FIREBASE_CLIENT_EMAIL,
-                    "client_id": Database.FIREBASE_CLIENT_ID,
+                    "project_id": settings.firebase_project_id,
+                    "private_key_id": settings.firebase_private_key_id,
+                    "private_key": settings.firebase_private_key,
+                    "client_email": settings.firebase_client_email,
+                    "client_id": settings.firebase_client_id,
                     "auth_uri": "https://accounts.google.com/o/oauth2/auth",
                     "token_uri": "https://oauth2.googleapis.com/token",
                     "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-                    "client_x509_cert_url": Database.FIREBASE_CLIENT_X509_CERT_URL,
+                    "client_x509_cert_url": settings.firebase_client_x509_cert_url,
                     "universe_domain": "googleapis.com",
                 }
             )
-
-            # Mark as initialized
-            Database._initialized = True
+        return Database._firebase_credentials
 
     async def get_db_client(self) -> AsyncClient:
-        return AsyncClient(
-            project=Database.FIREBASE_PROJECT_ID,
-            credentials=Database._firebase_credentials,
-        )
+        if Database._client is None:
+            Database._client = firestore.AsyncClient(
+                project=get_settings().firebase_project_id,
+                credentials=Database._credentials(),
+            )
+        return Database._client
+
+    async def open(self):
+        # Create the shared client and its transport up front so the first
+        # webhook doesn't pay for channel setup
+        client = await self.get_db_client()
+        client._firestore_api
+
+        Database._referral_credits.start()
+
+    async def close(self):
+        if Database._client is None:
+            return
+
+        try:
+            await Database._referral_credits.stop()
+        except Exception as error:
+            print(f"An error occurred flushing referral credits: {error}")
+
+        try:
+            await Database._client._firestore_api.transport.close()
+        except Exception as error:
+            print(f"An error occurred in close(): {error}")
+        finally:
+            Database._client = None
 
     async def query_user_ref(self, key, value) -> AsyncDocumentReference | None:
-        try: 
-            db: AsyncClient = await self.get_db_client()
-            # Query and get matching documents
-            query_ref = db.collection("users").where(key, "==", value)
-            results = query_ref.stream()
+        if key == "stripeCustomerId":
+            user_ref = Database._customer_refs.get(value)
+            if user_ref is not None:
+                return user_ref
+
+        db: AsyncClient = await self.get_db_client()
+        # Keys-only query, only the reference of the first match is needed
+        query_ref = (
+            db.collection("users")
+            .where(key, "==", value)
+            .select([DOCUMENT_ID])
+            .limit(1)
+        )
+
+        async def first_match():
+            async for doc in query_ref.stream():
+                return doc.reference
+
+        with metrics.span("firestore.query_user_ref", dependency="firestore"):
+            user_ref = await firestore_policy.call(first_match, idempotent=True)
+
+        if user_ref is not None and key == "stripeCustomerId":
+            Database._customer_refs.set(value, user_ref)
+        return user_ref
+
+    async def stream_users(
+        self, field_paths: list[str] | None = None, start_after: str | None = None
+    ):
+        db: AsyncClient = await self.get_db_client()
+        query = db.collection("users")
+        if field_paths is not None:
+            query = query.select(field_paths)
+
+        # Ordering by document ID gives a stable cursor to resume a scan from
+        query = query.order_by(DOCUMENT_ID)
+        if start_after is not None:
+            query = query.start_after({DOCUMENT_ID: start_after})
+
+        async for doc in query.stream():
+            yield doc
+
+    async def warm_customer_index(self):
+        # Only the customer ID is needed to build the index, so project the scan
+        db: AsyncClient = await self.get_db_client()
+        users = db.collection("users").select(["stripeCustomerId"]).stream()
 
-            # Return the document reference of the first match
-            async for doc in results:
-                return db.document(doc.reference.path)
+        async for doc in users:
+            stripe_customer_id = (doc.to_dict() or {}).get("stripeCustomerId")
+            if stripe_customer_id:
+                Database._customer_refs.set(stripe_customer_id, doc.reference)
 
+    def evict_user_ref(self, user_ref: AsyncDocumentReference):
+        # Called when a write finds the user deleted. Re-links made by other
+        # services can't be seen here and expire with the entry instead
+        for stripe_customer_id, cached_ref in Database._customer_refs.items():
+            if cached_ref.path == user_ref.path:
+                Database._customer_refs.pop(stripe_customer_id)
+
+    def customer_index_stats(self) -> dict:
+        return Database._customer_refs.stats()
+
+    async def flush_referral_credits(self):
+        # Lazy mode writes credits before the request returns, a serverless
+        # instance may be frozen before the flusher runs
+        try:
+            await Database._referral_credits.flush()
         except Exception as error:
-            print(f"An error occurred in query_user_ref(): {error}")
-            print(traceback.format_exc())
+            print(f"An error occurred flushing referral credits: {error}")
+
+    def referral_stats(self) -> dict:
+        return Database._referral_credits.stats()
+
+    async def get_user_snapshot(self, user_ref: AsyncDocumentReference, field_paths: list[str] | None = None):
+        # For callers that need the update time along with the data
+        with metrics.span("firestore.get_user", dependency="firestore"):
+            return await firestore_policy.call(user_ref.get, field_paths=field_paths, idempotent=True)
+
+    async def get_user(
+        self, user_ref: AsyncDocumentReference, field_paths: list[str] | None = None, transaction=None
+    ) -> dict | None:
+        """Read a user, only ``field_paths`` when given. None if the user doesn't exist."""
+        if transaction is not None:
+            # Transactions are retried as a whole by async_transactional
+            user_snapshot = await user_ref.get(field_paths=field_paths, transaction=transaction)
+        else:
+            user_snapshot = await firestore_policy.call(user_ref.get, field_paths=field_paths, idempotent=True)
+        if not user_snapshot.exists:
+            return None
+        return user_snapshot.to_dict() or {}
+
+    @staticmethod
+    def _layout() -> str:
+        return get_settings().subscription_layout
+
+    async def _blind_update(self, user_ref: AsyncDocumentReference, update: dict, stage: str) -> bool:
+        """Write field paths without reading, False if the user doesn't exist."""
+        try:
+            with metrics.span(stage, dependency="firestore"):
+                # Setting and deleting field paths is idempotent, so it can be retried
+                await firestore_policy.call(user_ref.update, update, idempotent=True)
+        except api_exceptions.NotFound:
+            self.evict_user_ref(user_ref)
+            return False
+        return True
 
     async def add_subscriptions(
         self, user_ref: AsyncDocumentReference, subscriptions_to_add
-    ):
-        try:
-            # Fetch user data
-            user_data = (await user_ref.get()).to_dict()
-            current_subscriptions = user_data.get("subscriptions", [])
+    ) -> bool:
+        """Add subscriptions to a user, returns False if the user doesn't exist."""
+        member_sub = member_subscription(subscriptions_to_add)
+
+        # With keyed entries only the ones being added are read, enough to
+        # keep an existing entry (and its override) as it is
+        keyed = self._layout() == MAP
+        if keyed:
+            field_paths = ["id", "referral.referredBy"] + [subscription_path(sub["id"]) for sub in subscriptions_to_add]
+        else:
+            field_paths = Database.SUBSCRIPTION_FIELDS
 
-            current_subscription_ids = {sub['id'] for sub in current_subscriptions}
+        db: AsyncClient = await self.get_db_client()
+
+        # Read and write the user in one transaction so concurrent events
+        # can't overwrite each other's changes
+        @firestore.async_transactional
+        async def add_in_transaction(transaction, user_ref: AsyncDocumentReference):
+            user_data = await self.get_user(user_ref, field_paths, transaction)
+            if user_data is None:
+                return None
+
+            current_subscription_ids = {sub['id'] for sub in subscription_list(user_data)}
 
             # Find subscriptions that are not already in the user's subscriptions
-            member_sub = None
-            new_subscriptions = []
-            for sub in subscriptions_to_add:
-                if sub['id'] not in current_subscription_ids:
-                    new_subscriptions.append(sub)
-                
-                if "member" in sub.get("name", ""):
-                    member_sub: dict = sub
-            
-            # Add the subscription name to the authentication field
-            # e.g. free, standard, pro, etc.
-            if member_sub is not None:
-                sub_name: str = member_sub.get("name", "")
-                name = sub_name.replace(" - member", "").lower()
-                authentication = user_data.get("authentication", {})
-                authentication["subscribed"] = name
+            new_subscriptions = [
+                sub for sub in subscriptions_to_add if sub['id'] not in current_subscription_ids
+            ]
 
-            # Add only new subscriptions
+            # Add only new subscriptions, in whichever layout the user is stored
             if new_subscriptions:
-                await user_ref.update(
-                    {
-                        "authentication": authentication,
-                        "subscriptions": firestore.ArrayUnion(new_subscriptions)
-                    }
-                )
-
-            # Fetch the user data
-            subscribed_user = (await user_ref.get()).to_dict()
-
-            # Check if the user was referred by another user
-            referred_by = subscribed_user.get("referral", {}).get("referredBy")
-
-            if referred_by:
-                db: AsyncClient = await self.get_db_client()
-                # Get the referring user
-                referring_user_query = db.collection("users").where(
-                    "referral.referralCode", "==", referred_by
-                )
-                referring_results = await referring_user_query.get()
-
-                for ref_doc in referring_results:
-                    referring_user_ref: AsyncDocumentReference = ref_doc.reference
-                    referring_user_data = ref_doc.to_dict()
-
-                    # Get the subscribed user's referral code
-                    subscribed_user_id = subscribed_user.get("id")
-
-                    # Check if referral code is already in valid_referrals
-                    if (
-                        subscribed_user_id
-                        and subscribed_user_id
-                        not in referring_user_data.get("referral", {}).get("validReferrals", [])
-                    ):
-                        # Add to valid_referrals using array_union
-                        await referring_user_ref.update({
-                            "referral.validReferrals": firestore.ArrayUnion([subscribed_user_id])
-                        })
+                if keyed or layout_of(user_data) == MAP:
+                    update = {subscription_path(sub["id"]): sub for sub in new_subscriptions}
+                else:
+                    update = {"subscriptions": firestore.ArrayUnion(new_subscriptions)}
 
-        except Exception as error:
-            print(f"An error occurred in remove_subscriptions(): {error}")
-            print(traceback.format_exc())
+                # Add the subscription name to the authentication field
+                # e.g. free, standard, pro, etc.
+                if member_sub is not None:
+                    update["authentication.subscribed"] = subscribed_name(member_sub)
+
+                transaction.update(user_ref, update)
+
+            # Check if the user was referred by another user, using the data
+            # read in the transaction rather than fetching the user again
+            Database._write_referral_credit(db, transaction, user_data)
+            return user_data
+
+        with metrics.span("firestore.add_subscriptions", dependency="firestore"):
+            user_data = await firestore_policy.call(add_in_transaction, db.transaction(), user_ref)
+        if user_data is None:
+            self.evict_user_ref(user_ref)
+            return False
+
+        if user_data.get("referral", {}).get("referredBy"):
+            Database._referral_credits.notify()
+
+        return True
+
+    async def swap_member_subscription(
+        self, user_ref: AsyncDocumentReference, new_subscription: dict
+    ) -> dict | None:
+        """Replace the user's member subscription with ``new_subscription``.
+
+        The subscriptions and ``authentication.subscribed`` are updated in a
+        single transactional write. Returns the member subscription that
+        was found, or None (and writes nothing) when the user has none.
+        """
+        db: AsyncClient = await self.get_db_client()
+
+        @firestore.async_transactional
+        async def swap_in_transaction(transaction, user_ref: AsyncDocumentReference):
+            user_data = await self.get_user(user_ref, Database.SUBSCRIPTION_FIELDS, transaction)
+            if user_data is None:
+                return None, None
+
+            subscriptions = subscription_list(user_data)
+
+            member_sub = member_subscription(subscriptions)
+            if member_sub is None:
+                return user_data, None
+
+            Database._write_referral_credit(db, transaction, user_data)
+
+            # Overridden subscriptions are kept alongside the new one
+            removed = member_sub.get("override") == False
+            if removed:
+                subscriptions = [sub for sub in subscriptions if sub.get("id") != member_sub.get("id")]
+
+            added = new_subscription["id"] not in {sub.get("id") for sub in subscriptions}
+            if added:
+                subscriptions.append(new_subscription)
+
+            if not (removed or added):
+                return user_data, member_sub
+
+            if layout_of(user_data) == MAP:
+                update = {}
+                if removed:
+                    update[subscription_path(member_sub["id"])] = firestore.DELETE_FIELD
+                if added:
+                    update[subscription_path(new_subscription["id"])] = new_subscription
+            else:
+                update = {"subscriptions": subscriptions}
+
+            if added and "member" in (new_subscription.get("name") or ""):
+                update["authentication.subscribed"] = subscribed_name(new_subscription)
+            elif removed:
+                update["authentication.subscribed"] = firestore.DELETE_FIELD
+
+            transaction.update(user_ref, update)
+            return user_data, member_sub
+
+        with metrics.span("firestore.swap_member_subscription", dependency="firestore"):
+            user_data, member_sub = await firestore_policy.call(swap_in_transaction, db.transaction(), user_ref)
+        if user_data is None:
+            self.evict_user_ref(user_ref)
+            raise UserNotFoundError(f"User not found. Path: {user_ref.path}")
+
+        referred_by = user_data.get("referral", {}).get("referredBy")
+        if member_sub is not None and referred_by:
+            Database._referral_credits.notify()
+
+        return member_sub
+
+    @staticmethod
+    def _fold_step(subscriptions: list[dict], action: str, subscription: dict) -> tuple[bool, Any]:
+        """Apply one step to ``subscriptions`` in place.
+
+        Follows the rules of add_subscriptions, swap_member_subscription and
+        remove_subscriptions. Returns whether the step matched the user's
+        subscriptions and the new ``authentication.subscribed`` value, or
+        None to leave it as it is.
+        """
+        ids = {sub.get("id") for sub in subscriptions}
+        is_member = "member" in (subscription.get("name") or "")
+
+        if action == "add":
+            if subscription["id"] not in ids:
+                subscriptions.append(subscription)
+            return True, subscribed_name(subscription) if is_member else None
+
+        if action == "swap":
+            member_sub = member_subscription(subscriptions)
+            if member_sub is None:
+                return False, None
+
+            removed = member_sub.get("override") == False
+            if removed:
+                subscriptions.remove(member_sub)
+                ids.discard(member_sub.get("id"))
+
+            if subscription["id"] not in ids:
+                subscriptions.append(subscription)
+                if is_member:
+                    return True, subscribed_name(subscription)
+            return True, firestore.DELETE_FIELD if removed else None
+
+        if action == "remove":
+            for sub in subscriptions:
+                if sub.get("id") == subscription["id"]:
+                    if sub.get("override") == False:
+                        subscriptions.remove(sub)
+                        return True, firestore.DELETE_FIELD
+                    return True, None
+            return False, None
+
+        raise ValueError(f"Unknown subscription step {action!r}")
+
+    async def apply_subscription_steps(
+        self, user_ref: AsyncDocumentReference, steps: list[tuple[str, dict]]
+    ) -> list[bool] | None:
+        """Fold ordered ``("add" | "swap" | "remove", subscription)`` steps into one write.
+
+        The user is read once in a transaction, every step is applied to the
+        subscriptions in memory and only the final state is written. Returns
+        whether each step matched the user's subscriptions, or None if the
+        user doesn't exist.
+        """
+        db: AsyncClient = await self.get_db_client()
+
+        @firestore.async_transactional
+        async def fold_in_transaction(transaction, user_ref: AsyncDocumentReference):
+            user_data = await self.get_user(user_ref, Database.SUBSCRIPTION_FIELDS, transaction)
+            if user_data is None:
+                return None, None
+
+            before = subscription_list(user_data)
+            subscriptions = list(before)
+
+            matched, subscribed = [], None
+            for action, subscription in steps:
+                found, step_subscribed = Database._fold_step(subscriptions, action, subscription)
+                matched.append(found)
+                if step_subscribed is not None:
+                    subscribed = step_subscribed
+
+            if layout_of(user_data) == MAP:
+                update = {
+                    subscription_path(sub["id"]): firestore.DELETE_FIELD
+                    for sub in before if sub not in subscriptions
+                }
+                update.update({
+                    subscription_path(sub["id"]): sub
+                    for sub in subscriptions if sub not in before
+                })
+            elif subscriptions != before:
+                update = {"subscriptions": subscriptions}
+            else:
+                update = {}
+
+            if subscribed is not None:
+                update["authentication.subscribed"] = subscribed
+            if update:
+                transaction.update(user_ref, update)
+
+            # Credited as add_subscriptions and swap_member_subscription would
+            if any(found and action != "remove" for (action, _), found in zip(steps, matched)):
+                Database._write_referral_credit(db, transaction, user_data)
+
+            return user_data, matched
+
+        with metrics.span("firestore.apply_subscription_steps", dependency="firestore"):
+            user_data, matched = await firestore_policy.call(fold_in_transaction, db.transaction(), user_ref)
+        if user_data is None:
+            self.evict_user_ref(user_ref)
+            return None
+
+        gained = any(found and action != "remove" for (action, _), found in zip(steps, matched))
+        if gained and user_data.get("referral", {}).get("referredBy"):
+            Database._referral_credits.notify()
+
+        return matched
+
+    @staticmethod
+    def _write_referral_credit(client: AsyncClient, writer, user_data: dict) -> bool:
+        """Record a pending credit for a referred user with ``writer``, a
+        transaction or batch, so it commits with the change that earned it."""
+        referred_by = user_data.get("referral", {}).get("referredBy")
+        if not (referred_by and user_data.get("id")):
+            return False
+
+        writer.set(*ReferralCredits.pending_credit(client, referred_by, user_data["id"]))
+        return True
+
+    async def get_subscriptions(
+        self, user_ref: AsyncDocumentReference, product_id: str | None = None
+    ) -> list[dict] | None:
+        """Read a user's subscriptions, None if the user doesn't exist.
+
+        With the map layout and a ``product_id`` only that entry is read.
+        """
+        if product_id is not None and self._layout() == MAP:
+            field_paths = [subscription_path(product_id)]
+        else:
+            field_paths = ["subscriptions"]
+
+        with metrics.span("firestore.get_subscriptions", dependency="firestore"):
+            user_data = await self.get_user(user_ref, field_paths)
+
+        if user_data is None:
+            self.evict_user_ref(user_ref)
+            return None
+
+        return subscription_list(user_data)
+
+    async def delete_subscription(self, user_ref: AsyncDocumentReference, product_id: str):
+        """Remove a subscription the caller has just read and found removable.
+
+        With the map layout the entry and ``authentication.subscribed`` are
+        deleted by field path in one write, without reading the user again.
+        """
+        if self._layout() != MAP:
+            # Array entries are removed by value, which needs the stored entry
+            await self.remove_subscriptions(user_ref, [{"id": product_id}])
+            return
+
+        update = {
+            subscription_path(product_id): firestore.DELETE_FIELD,
+            "authentication.subscribed": firestore.DELETE_FIELD,
+        }
+        # Deleting field paths is idempotent, so the write can be retried
+        await self._blind_update(user_ref, update, "firestore.delete_subscription")
 
     async def remove_subscriptions(
         self, user_ref: AsyncDocumentReference, subscriptions_to_remove
     ):
-        try: 
-            # Fetch the user's current subscriptions
-            user_snapshot = await user_ref.get()
-            user_data = user_snapshot.to_dict()
+        # With keyed entries only the ones being removed are read
+        keyed = self._layout() == MAP
+        if keyed:
+            field_paths = [subscription_path(sub["id"]) for sub in subscriptions_to_remove]
+        else:
+            field_paths = ["subscriptions"]
 
-            current_subscriptions = user_data.get("subscriptions", [])
-            authentication = user_data.get("authentication", {})    
+        # Fetch only the user's current subscriptions
+        with metrics.span("firestore.get_user", dependency="firestore"):
+            user_data = await self.get_user(user_ref, field_paths)
+        if user_data is None:
+            self.evict_user_ref(user_ref)
+            return
 
-            # Extract the IDs from the subscriptions to remove
-            subscription_ids_to_remove = {sub["id"] for sub in subscriptions_to_remove}
+        current_subscriptions = subscription_list(user_data)
 
-            # Create an array of subscriptions to remove based on IDs
-            subscriptions_to_remove_final = [
-                sub for sub in current_subscriptions if sub["id"] in subscription_ids_to_remove
-            ]
+        # Extract the IDs from the subscriptions to remove
+        subscription_ids_to_remove = {sub["id"] for sub in subscriptions_to_remove}
+
+        # Create an array of subscriptions to remove based on IDs
+        subscriptions_to_remove_final = [
+            sub for sub in current_subscriptions if sub["id"] in subscription_ids_to_remove
+        ]
 
-            if subscriptions_to_remove_final:
-                authentication.pop("subscribed", None)
+        if subscriptions_to_remove_final:
+            update = {"authentication.subscribed": firestore.DELETE_FIELD}
+            if keyed or layout_of(user_data) == MAP:
+                for sub in subscriptions_to_remove_final:
+                    update[subscription_path(sub["id"])] = firestore.DELETE_FIELD
+            else:
                 # Remove subscriptions by their ID using ArrayRemove
-                await user_ref.update(
-                    {
-                        "authentication": authentication,
-                        "subscriptions": firestore.ArrayRemove(subscriptions_to_remove_final)
-                    }
-                )
+                update["subscriptions"] = firestore.ArrayRemove(subscriptions_to_remove_final)
 
-        except Exception as error:
-            print(f"An error occurred in remove_subscriptions(): {error}")
-            print(traceback.format_exc())
+            # ArrayRemove and DELETE_FIELD are idempotent, so the write can be retried
+            await self._blind_update(user_ref, update, "firestore.remove_subscriptions")
+
+    @staticmethod
+    def _subscription_change_writes(change: dict) -> list[dict]:
+        subscriptions_to_remove = change.get("remove", [])
+        subscriptions_to_add = change.get("add", [])
+        member_sub = member_subscription(subscriptions_to_add)
+
+        subscribed = None
+        if member_sub is not None:
+            subscribed = subscribed_name(member_sub)
+        elif subscriptions_to_remove:
+            subscribed = firestore.DELETE_FIELD
+
+        # Keyed entries are all set or deleted in one write
+        if layout_of(change.get("user") or {}) == MAP:
+            if not (subscriptions_to_remove or subscriptions_to_add):
+                return []
+
+            update = {subscription_path(sub["id"]): firestore.DELETE_FIELD for sub in subscriptions_to_remove}
+            update.update({subscription_path(sub["id"]): sub for sub in subscriptions_to_add})
+            if subscribed is not None:
+                update["authentication.subscribed"] = subscribed
+            return [update]
+
+        # ArrayRemove and ArrayUnion can't share one update, so a change is
+        # up to two writes: removals first, then additions
+        writes = []
+        if subscriptions_to_remove:
+            update = {"subscriptions": firestore.ArrayRemove(subscriptions_to_remove)}
+            if member_sub is None:
+                update["authentication.subscribed"] = subscribed
+            writes.append(update)
+
+        if subscriptions_to_add:
+            update = {"subscriptions": firestore.ArrayUnion(subscriptions_to_add)}
+            if member_sub is not None:
+                update["authentication.subscribed"] = subscribed
+            writes.append(update)
+
+        return writes
+
+    async def _commit_writes(
+        self, db: AsyncClient, chunk: list[tuple], max_retries: int
+    ) -> str | None:
+        for attempt in range(max_retries + 1):
+            batch = db.batch()
+            for user_ref, writes, option, credit in chunk:
+                # A batch is atomic, so the precondition on a user's first
+                # write covers the rest
+                for index, update in enumerate(writes):
+                    batch.update(user_ref, update, option=option if index == 0 else None)
+                if credit is not None:
+                    batch.set(*credit)
+
+            try:
+                await batch.commit()
+                return None
+
+            except api_exceptions.FailedPrecondition:
+                # Retrying can't help, the change must be computed again
+                return Database.STALE_WRITE
+
+            except Exception as error:
+                # The writes are idempotent array transforms, so a retry is safe
+                if attempt == max_retries:
+                    print(f"An error occurred in _commit_writes(): {error}")
+                    return str(error)
+
+                await asyncio.sleep(min(10.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    async def bulk_apply_subscription_changes(
+        self, changes: list[dict], max_retries: int = 3
+    ) -> dict[str, str | None]:
+        """Apply many users' subscription diffs with batched writes.
+
+        Each change holds the user's ``ref``, the subscriptions to ``add``
+        and the exact stored subscriptions to ``remove``, plus optionally the
+        ``user`` data it was computed from (used to record referral credits
+        in the same batch) and
+        that snapshot's ``updateTime``. With an update time the user is only
+        written if it hasn't changed since, otherwise its result is
+        ``STALE_WRITE``. Writes are committed in WriteBatch chunks of up to
+        500, retrying a failed chunk. Returns each document path mapped to
+        None on success or to the error that made its chunk fail.
+        """
+        db: AsyncClient = await self.get_db_client()
+        results: dict[str, str | None] = {}
+
+        chunks, chunk, chunk_writes = [], [], 0
+        for change in changes:
+            writes = self._subscription_change_writes(change)
+            if not writes:
+                results[change["ref"].path] = None
+                continue
+
+            option = None
+            if change.get("updateTime") is not None:
+                option = db.write_option(last_update_time=change["updateTime"])
+
+            # Credit referrers of users who gain a subscription, in the same
+            # batch as the change
+            credit = None
+            user_data = change.get("user") or {}
+            referred_by = user_data.get("referral", {}).get("referredBy")
+            if change.get("add") and referred_by and user_data.get("id"):
+                credit = ReferralCredits.pending_credit(db, referred_by, user_data["id"])
+
+            size = len(writes) + (credit is not None)
+            if chunk_writes + size > Database.MAX_BATCH_WRITES:
+                chunks.append(chunk)
+                chunk, chunk_writes = [], 0
+
+            chunk.append((change["ref"], writes, option, credit))
+            chunk_writes += size
+
+        if chunk:
+            chunks.append(chunk)
+
+        for chunk in chunks:
+            error = await self._commit_writes(db, chunk, max_retries)
+            if error is not None and len(chunk) > 1:
+                # Commit users one by one to find which documents failed
+                for entry in chunk:
+                    results[entry[0].path] = await self._commit_writes(db, [entry], 0)
+                continue
+
+            for user_ref, _, _, _ in chunk:
+                results[user_ref.path] = error
+
+        if any(credit is not None and results[user_ref.path] is None
+               for chunk in chunks for user_ref, _, _, credit in chunk):
+            Database._referral_credits.notify()
+
+        return results
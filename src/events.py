@@ -0,0 +1,120 @@
+# Local Imports
+from src.exceptions import SignatureVerificationError
+
+# External Imports
+from typing import Any
+
+import hashlib
+import hmac
+import time
+
+# orjson decodes several times faster than json, use it when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class PlanView():
+    __slots__ = ("id", "product", "nickname")
+
+    def __init__(self, plan: dict):
+        self.id = plan.get("id")
+        product = plan.get("product")
+        # Expanded products (as listed by reconciliation) carry the ID inside
+        self.product = product.get("id") if isinstance(product, dict) else product
+        self.nickname = plan.get("nickname")
+
+
+class ObjectView():
+    """The fields handlers read from an event's ``data.object``."""
+
+    __slots__ = ("id", "object", "customer", "subscription", "plan")
+
+    def __init__(self, data_object: dict):
+        self.id = data_object.get("id")
+        self.object = data_object.get("object")
+        self.customer = data_object.get("customer")
+        self.subscription = data_object.get("subscription")
+
+        plan = data_object.get("plan")
+        self.plan = PlanView(plan) if plan else None
+
+
+class EventView():
+    """A Stripe event reduced to the fields the service uses."""
+
+    __slots__ = ("id", "type", "created", "object")
+
+    def __init__(self, id: str, type: str, created: int | None, object: ObjectView):
+        self.id = id
+        self.type = type
+        self.created = created
+        self.object = object
+
+    @classmethod
+    def from_dict(cls, event: dict) -> "EventView":
+        """Build a view from a decoded payload or a ``stripe.Event``."""
+        try:
+            return cls(
+                event["id"],
+                event["type"],
+                event.get("created"),
+                ObjectView(event["data"]["object"]),
+            )
+        except (KeyError, TypeError, AttributeError) as error:
+            raise ValueError(f"Malformed event: {error!r}") from None
+
+    def __repr__(self) -> str:
+        return f"EventView({self.id!r}, {self.type!r})"
+
+
+def _parse_header(sig_header: str) -> tuple[int, list[bytes]]:
+    timestamp = None
+    signatures = []
+    for item in sig_header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = int(value)
+        elif key == "v1":
+            signatures.append(value.encode())
+
+    if timestamp is None or not signatures:
+        raise ValueError("missing timestamp or v1 signature")
+    return timestamp, signatures
+
+
+def verify_signature(payload: bytes, sig_header: str | None, secrets: list[str], tolerance: int = 300):
+    """Check a ``Stripe-Signature`` header against the raw request body.
+
+    Follows Stripe's scheme, HMAC-SHA256 of ``"<timestamp>.<body>"``, and
+    accepts a signature made with any of ``secrets``.
+    """
+    try:
+        timestamp, signatures = _parse_header(sig_header or "")
+    except ValueError:
+        raise SignatureVerificationError("Unable to extract timestamp and signatures from header")
+
+    signed_payload = b"%d.%s" % (timestamp, payload)
+    for secret in secrets:
+        expected = hmac.new(secret.encode(), signed_payload, hashlib.sha256).hexdigest().encode()
+        if any(hmac.compare_digest(expected, signature) for signature in signatures):
+            break
+    else:
+        raise SignatureVerificationError("No signatures found matching the expected signature for payload")
+
+    if tolerance and timestamp < time.time() - tolerance:
+        raise SignatureVerificationError(f"Timestamp outside the tolerance zone ({timestamp})")
+
+
+def parse_event(payload: bytes, sig_header: str | None, secrets: list[str], tolerance: int = 300) -> EventView:
+    """Verify a webhook body and decode it into an ``EventView``.
+
+    Raises ``SignatureVerificationError`` for a bad signature and
+    ``ValueError`` for a body that isn't a Stripe event.
+    """
+    verify_signature(payload, sig_header, secrets, tolerance)
+    event: Any = json_loads(payload)
+    if not isinstance(event, dict):
+        raise ValueError("Malformed event: not a JSON object")
+    return EventView.from_dict(event)
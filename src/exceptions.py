@@ -2,4 +2,12 @@ class UserNotFoundError(Exception):
     """Exception raised when a user is not found in the database."""
     def __init__(self, message={"message": "Username doesn't exist", "code": 3}):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+
+class SignatureVerificationError(Exception):
+    """Exception raised when a webhook's signature doesn't match its payload."""
+
+
+class CircuitOpenError(Exception):
+    """Exception raised when a dependency's circuit breaker is rejecting calls."""
@@ -1,19 +1,145 @@
 # Local Imports
 from src.utils import format_date_to_iso
 from src.database import Database
+from src.stripe_api import retrieve_subscription
+from src.exceptions import UserNotFoundError
+from src.events import EventView, ObjectView
+from src.catalog import catalog
 
 # External Imports
 from fastapi.responses import JSONResponse
 from datetime import datetime, timezone
 
 import traceback
-import stripe
+import asyncio
 
 
-async def handle_subscription_update(
-    db: Database, stripe_customer_id: str, price_id: str, product_id: str
+async def handle_event(db: Database, event: EventView):
+    """Route a verified Stripe event to its handler."""
+    handler = EVENT_HANDLERS.get(event.type)
+    if handler is None:
+        print(f"Unhandled event type {event.type}")
+        return JSONResponse(
+            content={"message": f"Unhandled event type {event.type}"},
+            status_code=500,
+        )
+
+    return await handler(db, event.object)
+
+
+def subscription_entry(product_id: str, name: str | None) -> dict:
+    return {
+        "id": product_id,
+        "name": name,
+        "override": False,
+        "createdAt": format_date_to_iso(datetime.now(timezone.utc)),
+    }
+
+
+async def handle_events(db: Database, events: list[EventView]):
+    """Handle a burst of one customer's events, ordered by ``created``.
+
+    A single event goes to its handler. A longer burst is reduced to the
+    steps each event would have made, which are applied to the user in one
+    Database write, so only the final subscription state is stored.
+    """
+    if len(events) == 1:
+        return await handle_event(db, events[0])
+
+    stripe_customer_id = events[0].object.customer
+    event_ids = [event.id for event in events]
+    try:
+        user_ref = await db.query_user_ref("stripeCustomerId", stripe_customer_id)
+        if user_ref is None:
+            print(f"User not found. Customer ID: {stripe_customer_id}")
+            return JSONResponse(
+                content={
+                    "message": f"User not found. Customer ID: {stripe_customer_id}"
+                },
+                status_code=404,
+            )
+
+        # The Stripe and catalog lookups of every event run together
+        steps = await asyncio.gather(*(STEP_BUILDERS[event.type](event.object) for event in events))
+        matched = await db.apply_subscription_steps(user_ref, steps)
+        if matched is None:
+            print(f"User not found. Customer ID: {stripe_customer_id}")
+            return JSONResponse(
+                content={
+                    "message": f"User not found. Customer ID: {stripe_customer_id}"
+                },
+                status_code=404,
+            )
+
+        # A step that found nothing to change (e.g. an update for a user
+        # without a member subscription) is skipped, like its own handler
+        skipped = [event_id for event_id, found in zip(event_ids, matched) if not found]
+        if skipped:
+            print(f"Skipped events with no matching subscription: {skipped}")
+
+        return JSONResponse(
+            content={
+                "message": f"Applied {len(events)} events",
+                "events": event_ids,
+                "skipped": skipped,
+                "customer": stripe_customer_id,
+            },
+            status_code=200,
+        )
+
+    except Exception as error:
+        print(f"An error occurred in handle_events(): {error}")
+        print(traceback.format_exc())
+        return JSONResponse(
+            content={
+                "message": "Failed to update database for events",
+                "events": event_ids,
+                "error": str(error),
+            },
+            status_code=500,
+        )
+
+
+async def checkout_complete_step(session: ObjectView) -> tuple[str, dict]:
+    subscription = await retrieve_subscription(session.subscription)
+    price = await catalog.get_price(subscription["plan"]["id"])
+    return "add", subscription_entry(subscription["plan"]["product"], price["nickname"])
+
+
+async def subscription_updated_step(subscription: ObjectView) -> tuple[str, dict]:
+    price = await catalog.get_price(subscription.plan.id)
+    return "swap", subscription_entry(subscription.plan.product, price.get("nickname"))
+
+
+async def subscription_deleted_step(subscription: ObjectView) -> tuple[str, dict]:
+    return "remove", {"id": subscription.plan.product}
+
+
+async def on_checkout_complete(db: Database, session: ObjectView):
+    return await handle_checkout_complete(db, session.customer, session.subscription)
+
+
+async def on_subscription_updated(db: Database, subscription: ObjectView):
+    # This handles when the user has upgraded or downgraded their subscription
+    plan = subscription.plan
+    return await handle_subscription_update(db, subscription.customer, plan.id, plan.product)
+
+
+async def on_subscription_deleted(db: Database, subscription: ObjectView):
+    return await handle_subscription_deletion(db, subscription.customer, subscription.plan.product)
+
+
+async def handle_checkout_complete(
+    db: Database, stripe_customer_id: str, subscription_id: str
 ):
     try:
+        subscription = await retrieve_subscription(subscription_id)
+
+        product_id = subscription["plan"]["product"]
+        price_id = subscription["plan"]["id"]
+        price = await catalog.get_price(price_id)
+        data = subscription_entry(product_id, price["nickname"])
+
         user_ref = await db.query_user_ref("stripeCustomerId", stripe_customer_id)
         if user_ref is None:
             print(f"User not found. Customer ID: {stripe_customer_id}")
@@ -24,18 +150,48 @@ async def handle_subscription_update(
                 status_code=404,
             )
 
-        user_snapshot = await user_ref.get()
-        user = user_snapshot.to_dict()
+        if not await db.add_subscriptions(user_ref, [data]):
+            # The cached reference points at a deleted user
+            print(f"User not found. Customer ID: {stripe_customer_id}")
+            return JSONResponse(
+                content={
+                    "message": f"User not found. Customer ID: {stripe_customer_id}"
+                },
+                status_code=404,
+            )
+
+    except Exception as error:
+        print(f"An error occurred in handle_checkout_complete(): {error}")
+        print(traceback.format_exc())
+        return JSONResponse(
+            content={
+                "message": "Failed to update database for checkout",
+                "error": str(error),
+            },
+            status_code=500,
+        )
 
-        user_subscriptions = user.get("subscriptions", [])
 
-        # Get the users member subscription
-        user_member_subscription = None
-        for sub in user_subscriptions:
-            if "member" in sub.get("name"):
-                user_member_subscription = sub
-                break
+async def handle_subscription_update(
+    db: Database, stripe_customer_id: str, price_id: str, product_id: str
+):
+    try:
+        user_ref = await db.query_user_ref("stripeCustomerId", stripe_customer_id)
+        if user_ref is None:
+            print(f"User not found. Customer ID: {stripe_customer_id}")
+            return JSONResponse(
+                content={
+                    "message": f"User not found. Customer ID: {stripe_customer_id}"
+                },
+                status_code=404,
+            )
+
+        # Get the product name from the product id and then swap the new
+        # subscription in for the user's member subscription
+        price = await catalog.get_price(price_id)
+        new_subscription = subscription_entry(product_id, price.get("nickname"))
 
+        user_member_subscription = await db.swap_member_subscription(user_ref, new_subscription)
         if user_member_subscription is None:
             return JSONResponse(
                 content={
@@ -45,26 +201,17 @@ async def handle_subscription_update(
                 status_code=404,
             )
 
-        override = user_member_subscription.get("override")
-        if override == False:
-            # Remove the old subscription
-            await db.remove_subscriptions(
-                user_ref, [{"id": user_member_subscription.get("id")}]
-            )
-            print(f"Subscription inactive, removed {product_id} from user")
-
-        # Get the product name from the product id and then add the new subscription
-        price = stripe.Price.retrieve(price_id)
-        name = price.get("nickname")
-
-        new_subscription = {
-            "id": product_id,
-            "name": name,
-            "override": False,
-            "createdAt": format_date_to_iso(datetime.now(timezone.utc)),
-        }
+        if user_member_subscription.get("override") == False:
+            print(f"Subscription inactive, removed {user_member_subscription.get('id')} from user")
 
-        await db.add_subscriptions(user_ref, [new_subscription])
+    except UserNotFoundError:
+        print(f"User not found. Customer ID: {stripe_customer_id}")
+        return JSONResponse(
+            content={
+                "message": f"User not found. Customer ID: {stripe_customer_id}"
+            },
+            status_code=404,
+        )
 
     except Exception as e:
         print(f"An error occured in handle_subscription_update(): {e}")
@@ -89,9 +236,17 @@ async def handle_subscription_deletion(
                 status_code=404,
             )
 
-        user_snapshot = await user_ref.get()
-        user = user_snapshot.to_dict()
-        user_subscriptions = user.get("subscriptions", [])
+        # Only the subscriptions are read, just the one entry with the map layout
+        user_subscriptions = await db.get_subscriptions(user_ref, product_id)
+        if user_subscriptions is None:
+            # The cached reference points at a deleted user
+            print(f"User not found. Customer ID: {stripe_customer_id}")
+            return JSONResponse(
+                content={
+                    "message": f"User not found. Customer ID: {stripe_customer_id}"
+                },
+                status_code=404,
+            )
 
         user_subscription = None
         for sub in user_subscriptions:
@@ -110,7 +265,8 @@ async def handle_subscription_deletion(
 
         override = user_subscription.get("override")
         if override == False:
-            await db.remove_subscriptions(user_ref, [{"id": product_id}])
+            # The entry was just read, so it is deleted without another read
+            await db.delete_subscription(user_ref, product_id)
 
             print(f"Subscription inactive, removed {product_id} from user")
             return JSONResponse(
@@ -139,3 +295,18 @@ async def handle_subscription_deletion(
             },
             status_code=500,
         )
+
+
+# Event type -> handler, each is given the event's data object
+EVENT_HANDLERS = {
+    "checkout.session.completed": on_checkout_complete,
+    "customer.subscription.updated": on_subscription_updated,
+    "customer.subscription.deleted": on_subscription_deleted,
+}
+
+# Event type -> the Database step it makes, used to fold a burst of events
+STEP_BUILDERS = {
+    "checkout.session.completed": checkout_complete_step,
+    "customer.subscription.updated": subscription_updated_step,
+    "customer.subscription.deleted": subscription_deleted_step,
+}
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+# Local Imports
+from src.database import Database
+from src.lazy import lazy_import
+
+# External Imports
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+
+import traceback
+import asyncio
+import socket
+import uuid
+import os
+
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1 import AsyncDocumentReference
+
+firestore = lazy_import("google.cloud.firestore")
+
+
+class JobLease():
+    """Lease and checkpoint for a background job, stored in ``jobs/<name>``.
+
+    Only the instance holding an unexpired lease may run the job. The
+    holder renews it periodically and stores a checkpoint so an interrupted
+    run can pick up where it stopped. Checkpoints are only written while
+    the lease is still held, so a holder that lost it can't overwrite the
+    progress of the next one.
+    """
+
+    COLLECTION = "jobs"
+
+    def __init__(self, db: Database, name: str, ttl: float = 120.0):
+        self.db = db
+        self.name = name
+        self.ttl = timedelta(seconds=ttl)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Set once keep_alive finds another instance holding the lease
+        self.lost = False
+
+    async def _doc_ref(self) -> AsyncDocumentReference:
+        client = await self.db.get_db_client()
+        return client.collection(self.COLLECTION).document(self.name)
+
+    async def acquire(self) -> bool:
+        """Take (or renew) the lease, returns False when another instance holds it."""
+        client = await self.db.get_db_client()
+        doc_ref = await self._doc_ref()
+
+        @firestore.async_transactional
+        async def acquire_in_transaction(transaction, doc_ref: AsyncDocumentReference):
+            snapshot = await doc_ref.get(transaction=transaction)
+            job = snapshot.to_dict() if snapshot.exists else {}
+
+            now = datetime.now(timezone.utc)
+            lease_owner = job.get("leaseOwner")
+            lease_expires_at = job.get("leaseExpiresAt")
+            if lease_owner not in (None, self.owner) and lease_expires_at and lease_expires_at > now:
+                return False
+
+            transaction.set(
+                doc_ref,
+                {"leaseOwner": self.owner, "leaseExpiresAt": now + self.ttl},
+                merge=True,
+            )
+            return True
+
+        return await acquire_in_transaction(client.transaction(), doc_ref)
+
+    async def keep_alive(self, task: asyncio.Task):
+        """Renew the lease until cancelled, cancelling ``task`` if it is lost."""
+        while True:
+            await asyncio.sleep(self.ttl.total_seconds() / 3)
+            try:
+                if not await self.acquire():
+                    print(f"Lost the lease for job {self.name}, stopping")
+                    self.lost = True
+                    task.cancel()
+                    return
+
+            except Exception as error:
+                print(f"An error occurred renewing the lease for job {self.name}: {error}")
+
+    async def release(self):
+        try:
+            client = await self.db.get_db_client()
+            doc_ref = await self._doc_ref()
+
+            # Only clear the lease if another instance hasn't taken it over
+            @firestore.async_transactional
+            async def release_in_transaction(transaction, doc_ref: AsyncDocumentReference):
+                snapshot = await doc_ref.get(transaction=transaction)
+                if snapshot.exists and snapshot.get("leaseOwner") == self.owner:
+                    transaction.update(doc_ref, {"leaseOwner": None, "leaseExpiresAt": None})
+
+            await release_in_transaction(client.transaction(), doc_ref)
+
+        except Exception as error:
+            print(f"An error occurred in release(): {error}")
+            print(traceback.format_exc())
+
+    async def load(self) -> dict:
+        snapshot = await (await self._doc_ref()).get()
+        return snapshot.to_dict() if snapshot.exists else {}
+
+    async def save(self, state: dict) -> bool:
+        """Merge ``state`` into the job, returns False if the lease is no longer held."""
+        client = await self.db.get_db_client()
+        doc_ref = await self._doc_ref()
+
+        @firestore.async_transactional
+        async def save_in_transaction(transaction, doc_ref: AsyncDocumentReference):
+            snapshot = await doc_ref.get(field_paths=["leaseOwner"], transaction=transaction)
+            if not snapshot.exists or snapshot.get("leaseOwner") != self.owner:
+                return False
+
+            transaction.set(doc_ref, {**state, "updatedAt": datetime.now(timezone.utc)}, merge=True)
+            return True
+
+        saved = await save_in_transaction(client.transaction(), doc_ref)
+        if not saved:
+            print(f"The lease for job {self.name} is held by another instance, not saving")
+        return saved
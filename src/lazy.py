@@ -0,0 +1,41 @@
+# Local Imports
+
+
+# External Imports
+import importlib.util
+import types
+import sys
+
+# Names of the modules handed out lazily, see load_all()
+_lazy_modules: list[str] = []
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Return the module ``name`` without executing it until an attribute is used.
+
+    Keeps heavy SDKs (stripe, firestore) out of cold-start import time.
+    Setting attributes on the module before it loads is preserved.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    _lazy_modules.append(name)
+    return module
+
+
+def load_all():
+    """Execute every lazily imported module now.
+
+    For a server that imports the app once and forks its workers, so the
+    SDKs are loaded before the fork rather than in each worker. Only
+    imports the modules, no clients are created.
+    """
+    for name in _lazy_modules:
+        # Any attribute access runs a lazy module
+        getattr(sys.modules[name], "__name__")
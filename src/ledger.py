@@ -0,0 +1,91 @@
+# Local Imports
+from src.database import Database
+from src.cache import TTLCache
+from src.resilience import firestore_policy
+from src.metrics import metrics
+
+# External Imports
+from datetime import datetime, timedelta, timezone
+
+import traceback
+
+
+class EventLedger():
+    """Records which Stripe events have been handled so retries can be skipped.
+
+    Lookups check an in-process LRU first and then the ``processed_events``
+    collection. Events that failed after Stripe was already answered are
+    written to ``failed_events``, keyed by event ID, for an operator (or
+    ``python -m src.reconciliation --full``) to act on. Documents carry an
+    ``expiresAt`` timestamp, configure a Firestore TTL policy on that field
+    to have old entries cleaned up.
+    """
+
+    COLLECTION = "processed_events"
+    FAILED_COLLECTION = "failed_events"
+
+    def __init__(self, db: Database, maxsize: int = 10_000, retention_days: int = 30):
+        self.db = db
+        self.retention = timedelta(days=retention_days)
+        self._recent = TTLCache(maxsize=maxsize, ttl=self.retention.total_seconds())
+
+    async def seen(self, event_id: str) -> bool:
+        if event_id in self._recent:
+            return True
+
+        try:
+            client = await self.db.get_db_client()
+            with metrics.span("firestore.ledger_seen", dependency="firestore"):
+                doc_ref = client.collection(self.COLLECTION).document(event_id)
+                snapshot = await firestore_policy.call(doc_ref.get, idempotent=True)
+            if snapshot.exists:
+                self._recent.set(event_id, True)
+                return True
+
+        except Exception as error:
+            # A ledger failure must never stop an event from being processed
+            print(f"An error occurred in seen(): {error}")
+            print(traceback.format_exc())
+
+        return False
+
+    def stats(self) -> dict:
+        return self._recent.stats()
+
+    async def mark_processed(self, event_id: str, event_type: str):
+        self._recent.set(event_id, True)
+
+        try:
+            now = datetime.now(timezone.utc)
+            client = await self.db.get_db_client()
+            with metrics.span("firestore.ledger_mark_processed", dependency="firestore"):
+                doc_ref = client.collection(self.COLLECTION).document(event_id)
+                await firestore_policy.call(
+                    doc_ref.set,
+                    {
+                        "type": event_type,
+                        "processedAt": now,
+                        "expiresAt": now + self.retention,
+                    },
+                    idempotent=True,
+                )
+
+        except Exception as error:
+            print(f"An error occurred in mark_processed(): {error}")
+            print(traceback.format_exc())
+
+    async def mark_failed(self, event_id: str, event_type: str, error: Exception):
+        now = datetime.now(timezone.utc)
+        client = await self.db.get_db_client()
+        with metrics.span("firestore.ledger_mark_failed", dependency="firestore"):
+            doc_ref = client.collection(self.FAILED_COLLECTION).document(event_id)
+            await firestore_policy.call(
+                doc_ref.set,
+                {
+                    "type": event_type,
+                    "error": str(error),
+                    "failedAt": now,
+                    "expiresAt": now + self.retention,
+                },
+                idempotent=True,
+            )
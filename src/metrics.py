@@ -0,0 +1,257 @@
+# Local Imports
+from src.config import get_settings
+
+# External Imports
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict
+from typing import Callable, Iterator
+
+import bisect
+import json
+import time
+
+
+# Latency buckets in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# External calls made by one webhook
+CALL_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12)
+
+DEPENDENCIES = ("stripe", "firestore")
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: dict | None = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+class Histogram():
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Trace():
+    """Stage timings and external calls collected for one webhook."""
+
+    __slots__ = ("endpoint", "event_type", "event_id", "status", "stages", "calls")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.event_type = "unknown"
+        self.event_id = None
+        self.status = None
+        self.stages: dict[str, float] = defaultdict(float)
+        self.calls: dict[str, int] = defaultdict(int)
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def _noop() -> Iterator[None]:
+    yield None
+
+
+class Metrics():
+    """Process-wide counters, histograms and gauges, rendered for Prometheus.
+
+    Hot-path stages are timed with ``span``. Inside a ``webhook`` trace the
+    spans are also summed per webhook and written as one JSON log line when
+    it finishes. When disabled, ``span`` and ``webhook`` hand back a no-op
+    context manager and nothing is recorded.
+    """
+
+    def __init__(self, enabled: bool = True, structured_logs: bool = True):
+        self.enabled = enabled
+        self.structured_logs = structured_logs
+        self._counters: dict[str, dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self._histograms: dict[str, dict[tuple, Histogram]] = defaultdict(dict)
+        self._buckets: dict[str, tuple] = {}
+        self._gauges: dict[str, Callable] = {}
+        self._help: dict[str, str] = {
+            "payments_stage_duration_seconds": "Time spent in each hot-path stage",
+            "payments_external_calls_total": "Calls made to Stripe and Firestore",
+            "payments_webhook_duration_seconds": "Webhook latency by event type",
+            "payments_webhooks_total": "Webhooks handled by event type and outcome",
+            "payments_webhook_external_calls": "External calls made per webhook",
+        }
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            self._counters[name][_label_key(labels)] += value
+
+    def observe(self, name: str, value: float, buckets: tuple = DURATION_BUCKETS, **labels):
+        if not self.enabled:
+            return
+
+        series = self._histograms[name]
+        key = _label_key(labels)
+        if key not in series:
+            series[key] = Histogram(self._buckets.setdefault(name, buckets))
+        series[key].observe(value)
+
+    def gauge(self, name: str, help_text: str, callback: Callable):
+        """Register a gauge read at scrape time.
+
+        ``callback`` returns a number or a list of ``(labels, value)`` pairs.
+        """
+        self._gauges[name] = callback
+        self._help[name] = help_text
+
+    def span(self, stage: str, dependency: str | None = None):
+        """Time a stage, counting it as an external call when ``dependency`` is set."""
+        if not self.enabled:
+            return _noop()
+        return self._span(stage, dependency)
+
+    @contextmanager
+    def _span(self, stage: str, dependency: str | None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe("payments_stage_duration_seconds", elapsed, stage=stage)
+            if dependency is not None:
+                self.inc("payments_external_calls_total", dependency=dependency, operation=stage)
+
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.stages[stage] += elapsed
+                if dependency is not None:
+                    trace.calls[dependency] += 1
+
+    def webhook(self, endpoint: str):
+        """Trace one webhook, yields the ``Trace`` (None when disabled)."""
+        if not self.enabled:
+            return _noop()
+        return self._webhook(endpoint)
+
+    @contextmanager
+    def _webhook(self, endpoint: str):
+        trace = Trace(endpoint)
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        outcome = None
+
+        try:
+            yield trace
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            _current_trace.reset(token)
+            elapsed = time.perf_counter() - started
+            if outcome is None:
+                outcome = f"{trace.status // 100}xx" if trace.status else "ok"
+
+            self.observe("payments_webhook_duration_seconds", elapsed, event_type=trace.event_type)
+            self.inc("payments_webhooks_total", event_type=trace.event_type, outcome=outcome)
+            for dependency in DEPENDENCIES:
+                self.observe(
+                    "payments_webhook_external_calls",
+                    trace.calls.get(dependency, 0),
+                    buckets=CALL_BUCKETS,
+                    dependency=dependency,
+                )
+
+            if self.structured_logs:
+                print(json.dumps({
+                    "log": "webhook",
+                    "endpoint": trace.endpoint,
+                    "event_type": trace.event_type,
+                    "event_id": trace.event_id,
+                    "status": trace.status,
+                    "outcome": outcome,
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "stages_ms": {stage: round(value * 1000, 2) for stage, value in trace.stages.items()},
+                    "external_calls": dict(trace.calls),
+                }))
+
+    def tag(self, event):
+        """Attach a verified event's type and ID to the current webhook trace."""
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.event_type = event.type
+            trace.event_id = event.id
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name: str, kind: str):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(self._counters.items()):
+            header(name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_format_labels(key)} {value:g}")
+
+        for name, series in sorted(self._histograms.items()):
+            header(name, "histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, {'le': f'{bound:g}'})} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, {'le': '+Inf'})} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum:g}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+
+        for name, callback in sorted(self._gauges.items()):
+            try:
+                value = callback()
+            except Exception as error:
+                print(f"An error occurred reading gauge {name}: {error}")
+                continue
+
+            header(name, "gauge")
+            if isinstance(value, (int, float)):
+                lines.append(f"{name} {value:g}")
+                continue
+
+            for labels, sample in value:
+                lines.append(f"{name}{_format_labels(_label_key(labels))} {sample:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware():
+    """ASGI middleware tracing requests to the given webhook paths."""
+
+    def __init__(self, app, metrics: Metrics, paths: set[str]):
+        self.app = app
+        self.metrics = metrics
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        with self.metrics.webhook(scope["path"]) as trace:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    trace.status = message["status"]
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+_settings = get_settings()
+metrics = Metrics(enabled=_settings.metrics_enabled, structured_logs=_settings.structured_logs)
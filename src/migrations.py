@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+# Local Imports
+from src.subscriptions import ARRAY, MAP, layout_of, subscription_list, to_map
+from src.database import Database
+
+# External Imports
+from typing import TYPE_CHECKING
+
+import argparse
+import asyncio
+
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1 import AsyncClient
+
+
+def convert(user: dict, layout: str) -> list[dict] | dict[str, dict] | None:
+    """Return the user's subscriptions in ``layout``, None if already there."""
+    if layout_of(user) == layout or user.get("subscriptions") is None:
+        return None
+
+    subscriptions = subscription_list(user)
+    return to_map(subscriptions) if layout == MAP else subscriptions
+
+
+class SubscriptionMigration():
+    """Rewrites every user's ``subscriptions`` field into another layout.
+
+    Users are scanned in document ID order, projected to the one field,
+    and written in batches. Each write is conditioned on the document's
+    update time, so a user changed by a webhook since the scan fails the
+    batch rather than losing that change; the batch is then retried one
+    user at a time from a fresh read.
+    """
+
+    def __init__(self, db: Database, layout: str = MAP, batch_size: int = 400, dry_run: bool = False):
+        self.db = db
+        self.layout = layout
+        self.batch_size = max(1, min(batch_size, Database.MAX_BATCH_WRITES))
+        self.dry_run = dry_run
+
+        self.scanned = 0
+        self.migrated = 0
+        self.failed = 0
+        self.cursor: str | None = None
+
+    async def _commit(self, client: AsyncClient, chunk: list[tuple]) -> bool:
+        batch = client.batch()
+        for snapshot, subscriptions in chunk:
+            batch.update(
+                snapshot.reference,
+                {"subscriptions": subscriptions},
+                option=client.write_option(last_update_time=snapshot.update_time),
+            )
+
+        try:
+            await batch.commit()
+            return True
+        except Exception as error:
+            print(f"An error occurred committing a migration batch: {error}")
+            return False
+
+    async def _retry_one(self, client: AsyncClient, snapshot) -> bool:
+        fresh = await snapshot.reference.get(field_paths=["subscriptions"])
+        if not fresh.exists:
+            return True
+
+        subscriptions = convert(fresh.to_dict() or {}, self.layout)
+        if subscriptions is None:
+            return True
+
+        return await self._commit(client, [(fresh, subscriptions)])
+
+    async def _flush(self, client: AsyncClient, chunk: list[tuple]):
+        if self.dry_run or not chunk:
+            self.migrated += len(chunk)
+            return
+
+        if await self._commit(client, chunk):
+            self.migrated += len(chunk)
+            return
+
+        for snapshot, _ in chunk:
+            if await self._retry_one(client, snapshot):
+                self.migrated += 1
+            else:
+                self.failed += 1
+                print(f"Failed to migrate {snapshot.reference.path}")
+
+    async def run(self, start_after: str | None = None) -> dict:
+        client = await self.db.get_db_client()
+        chunk = []
+
+        async for snapshot in self.db.stream_users(["subscriptions"], start_after=start_after):
+            self.scanned += 1
+            subscriptions = convert(snapshot.to_dict() or {}, self.layout)
+            if subscriptions is not None:
+                chunk.append((snapshot, subscriptions))
+
+            if len(chunk) >= self.batch_size:
+                await self._flush(client, chunk)
+                chunk = []
+                self.cursor = snapshot.id
+                print(f"Migration progress: {self.stats()}")
+
+        await self._flush(client, chunk)
+        self.cursor = None
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {
+            "layout": self.layout,
+            "dry_run": self.dry_run,
+            "scanned": self.scanned,
+            "migrated": self.migrated,
+            "failed": self.failed,
+            "cursor": self.cursor,
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Convert user subscriptions between storage layouts")
+    parser.add_argument("--to", choices=[MAP, ARRAY], default=MAP, help="layout to convert users to")
+    parser.add_argument("--batch-size", type=int, default=400)
+    parser.add_argument("--start-after", help="user ID to resume after, printed with each progress line")
+    parser.add_argument("--dry-run", action="store_true", help="count the users without writing")
+    args = parser.parse_args()
+
+    db = Database()
+    await db.open()
+
+    try:
+        migration = SubscriptionMigration(db, args.to, args.batch_size, args.dry_run)
+        print(await migration.run(args.start_after))
+
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
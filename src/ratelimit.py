@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+# Local Imports
+from src.metrics import metrics
+
+# External Imports
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import asyncio
+import uuid
+import time
+
+
+class MemoryBackend():
+    """Counters held in this process, the default for a single instance."""
+
+    def __init__(self):
+        self._counters: dict[str, tuple[float, int]] = {}
+        self._slots: dict[str, int] = {}
+
+    def _prune(self, now: float):
+        if len(self._counters) > 10_000:
+            self._counters = {key: entry for key, entry in self._counters.items() if entry[0] > now}
+
+    async def incr(self, key: str, window: float) -> int:
+        now = time.monotonic()
+        expires_at, count = self._counters.get(key, (0.0, 0))
+        if expires_at <= now:
+            self._prune(now)
+            expires_at, count = now + window, 0
+
+        self._counters[key] = (expires_at, count + 1)
+        return count + 1
+
+    async def get(self, key: str) -> int:
+        expires_at, count = self._counters.get(key, (0.0, 0))
+        return count if expires_at > time.monotonic() else 0
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> str | None:
+        if self._slots.get(key, 0) >= limit:
+            return None
+        self._slots[key] = self._slots.get(key, 0) + 1
+        return uuid.uuid4().hex
+
+    async def release(self, key: str, token: str):
+        remaining = self._slots.get(key, 0) - 1
+        if remaining > 0:
+            self._slots[key] = remaining
+        else:
+            self._slots.pop(key, None)
+
+    async def close(self):
+        pass
+
+
+class RedisBackend():
+    """Counters shared by every worker and instance through a Redis server.
+
+    Speaks only basic commands (INCR, EXPIRE, TTL, GET and the sorted set
+    commands), so any server implementing the Redis protocol works. Each
+    slot is a member of a sorted set scored by when it was taken, members
+    older than ``ttl`` are pruned, so a slot held by a crashed worker is
+    freed however often the customer is retried.
+    """
+
+    def __init__(self, url: str, prefix: str = "payments:ratelimit:"):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("The redis rate limit backend needs the redis package installed") from None
+
+        self.prefix = prefix
+        self._redis = redis.asyncio.from_url(url)
+
+    async def incr(self, key: str, window: float) -> int:
+        key = self.prefix + key
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.ttl(key)
+            count, ttl = await pipe.execute()
+
+        # Only the first hit sets the expiry, keeping the window fixed
+        if ttl < 0:
+            await self._redis.expire(key, max(1, int(window)))
+        return count
+
+    async def get(self, key: str) -> int:
+        value = await self._redis.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> str | None:
+        key = self.prefix + key
+        token = uuid.uuid4().hex
+        now = time.time()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, "-inf", now - ttl)
+            pipe.zadd(key, {token: now})
+            pipe.zrank(key, token)
+            pipe.expire(key, max(1, int(ttl)))
+            _, _, rank, _ = await pipe.execute()
+
+        if rank >= limit:
+            await self._redis.zrem(key, token)
+            return None
+        return token
+
+    async def release(self, key: str, token: str):
+        await self._redis.zrem(self.prefix + key, token)
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+class RateLimiter():
+    """Limits keyed by what a request proves rather than where it came from.
+
+    Verified Stripe events are never limited by IP. They take a slot from a
+    per-customer concurrency limit, so a replayed backlog is smoothed out
+    instead of rejected. Only addresses that keep sending bad signatures
+    are blocked, for the rest of the window.
+    """
+
+    def __init__(
+        self,
+        backend: MemoryBackend | RedisBackend,
+        customer_concurrency: int = 1,
+        slot_timeout: float = 10.0,
+        slot_ttl: float = 60.0,
+        invalid_limit: int = 20,
+        invalid_window: float = 60.0,
+    ):
+        self.backend = backend
+        self.customer_concurrency = max(1, customer_concurrency)
+        self.slot_timeout = slot_timeout
+        self.slot_ttl = slot_ttl
+        self.invalid_limit = invalid_limit
+        self.invalid_window = invalid_window
+
+    async def hit(self, key: str, limit: int, window: float) -> bool:
+        """Count a request against a fixed window, False once over ``limit``."""
+        try:
+            allowed = await self.backend.incr(key, window) <= limit
+        except Exception as error:
+            # Fail open, a limiter outage must not stop webhooks
+            print(f"An error occurred in hit(): {error}")
+            return True
+
+        if not allowed:
+            metrics.inc("payments_rate_limited_total", reason=key.split(":", 1)[0])
+        return allowed
+
+    async def blocked(self, client_ip: str | None) -> bool:
+        """True when ``client_ip`` has sent too many bad signatures recently."""
+        try:
+            blocked = await self.backend.get(f"invalid:{client_ip}") >= self.invalid_limit
+        except Exception as error:
+            print(f"An error occurred in blocked(): {error}")
+            return False
+
+        if blocked:
+            metrics.inc("payments_rate_limited_total", reason="invalid")
+        return blocked
+
+    async def record_invalid(self, client_ip: str | None):
+        try:
+            await self.backend.incr(f"invalid:{client_ip}", self.invalid_window)
+        except Exception as error:
+            print(f"An error occurred in record_invalid(): {error}")
+
+    @asynccontextmanager
+    async def customer_slot(self, customer_id: str | None) -> AsyncIterator[bool]:
+        """Hold one of the customer's concurrency slots.
+
+        Waits up to ``slot_timeout`` for a slot and yields whether one was
+        taken. Events with no customer are never limited.
+        """
+        if customer_id is None:
+            yield True
+            return
+
+        key = f"customer:{customer_id}"
+        token = await self._acquire(key)
+        if token is False:
+            metrics.inc("payments_rate_limited_total", reason="customer")
+
+        try:
+            yield token is not False
+        finally:
+            if token:
+                try:
+                    await self.backend.release(key, token)
+                except Exception as error:
+                    print(f"An error occurred releasing {key}: {error}")
+
+    async def _acquire(self, key: str) -> str | bool | None:
+        # The slot's token, False when none was free in time, or None when
+        # the backend failed and the request goes ahead unlimited
+        deadline = time.monotonic() + self.slot_timeout
+        delay = 0.05
+        while True:
+            try:
+                token = await self.backend.acquire(key, self.customer_concurrency, self.slot_ttl)
+                if token is not None:
+                    return token
+            except Exception as error:
+                print(f"An error occurred acquiring {key}: {error}")
+                return None
+
+            if time.monotonic() + delay > deadline:
+                return False
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+
+def create_limiter(settings) -> RateLimiter:
+    if settings.rate_limit_backend == "redis":
+        backend = RedisBackend(settings.rate_limit_redis_url)
+    else:
+        backend = MemoryBackend()
+
+    return RateLimiter(
+        backend,
+        customer_concurrency=settings.webhook_customer_concurrency,
+        invalid_limit=settings.invalid_signature_limit,
+    )
@@ -0,0 +1,593 @@
+# Local Imports
+from src.stripe_api import (
+    setup_stripe,
+    close_stripe,
+    list_all_subscriptions,
+    list_customer_ids,
+    list_events,
+)
+from src.handlers import handle_event
+from src.events import EventView
+from src.subscriptions import subscription_list
+from src.resilience import stripe_policy, stripe_unavailable
+from src.ledger import EventLedger
+from src.jobs import JobLease
+from src.utils import format_date_to_iso
+from src.database import Database
+from src.config import get_settings
+from src.lazy import lazy_import
+
+# External Imports
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+import traceback
+import argparse
+import asyncio
+import random
+import time
+
+stripe = lazy_import("stripe")
+
+
+class ReconciliationEngine():
+    """Brings every user's subscriptions in line with Stripe.
+
+    Stripe is read in bulk (all subscriptions with their plan products
+    expanded, plus the set of customer IDs) into an in-memory index, which
+    is then joined against a projected scan of ``users``.
+    Note: 'user' refers to database and 'customer' refers to stripe
+    """
+
+    USER_FIELDS = ["id", "stripeCustomerId", "subscriptions", "referral.referredBy"]
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.customer_ids: set[str] = set()
+        # (product ID, product name, plan nickname) per subscription, all
+        # that diff() reads, so each Stripe page is freed once indexed
+        self.subscriptions_by_customer: dict[str, list[tuple[str, str, str]]] = defaultdict(list)
+
+        # Progress counters
+        self.users_scanned = 0
+        self.users_updated = 0
+        self.stripe_calls = 0
+        self.started_at = None
+
+    async def call_stripe(self, method, **params):
+        self.stripe_calls += 1
+        return await stripe_policy.call(method, idempotent=True, **params)
+
+    async def build_index(self):
+        self.customer_ids = set()
+        self.subscriptions_by_customer = defaultdict(list)
+
+        async for customer_id in list_customer_ids(self.call_stripe):
+            self.customer_ids.add(customer_id)
+
+        async for subscription in list_all_subscriptions(self.call_stripe):
+            plan = subscription["plan"]
+            product = plan["product"]
+            self.subscriptions_by_customer[subscription["customer"]].append(
+                (product["id"], product["name"], plan["nickname"])
+            )
+
+    def diff(self, user: dict, stripe_customer_subscriptions: list[tuple[str, str, str]]) -> tuple[list, list]:
+        subscriptions_to_add = []
+        subscriptions_to_remove = []
+
+        user_subscriptions = subscription_list(user)
+        user_subscription_ids = {sub.get("id") for sub in user_subscriptions}
+
+        # Add any subscriptions the user now has
+        for product_id, product_name, _ in stripe_customer_subscriptions:
+            if product_id in user_subscription_ids:
+                continue
+
+            subscriptions_to_add.append(
+                {
+                    "name": product_name,
+                    "id": product_id,
+                    "override": False,
+                    "createdAt": format_date_to_iso(datetime.now()),
+                }
+            )
+
+        stripe_customer_subscription_names = [nickname for _, _, nickname in stripe_customer_subscriptions]
+
+        # Identify subscriptions to remove
+        for subscription in user_subscriptions:
+            if subscription.get("name") == "admin":
+                subscriptions_to_remove = []
+                break
+
+            if (subscription.get("name") not in stripe_customer_subscription_names) and (subscription.get("override") == False):
+                subscriptions_to_remove.append(subscription)
+
+        return subscriptions_to_add, subscriptions_to_remove
+
+    def user_change(self, user_ref, user: dict, update_time=None) -> dict | None:
+        """Return the subscription change for a user, or None if there is none.
+
+        ``update_time`` is that of the snapshot ``user`` was read from, the
+        change is only written if the user hasn't been updated since.
+        """
+        stripe_customer_id = user.get("stripeCustomerId")
+
+        # Customers missing from the index belong to the other Stripe mode
+        # (test vs live), so leave those users alone
+        if stripe_customer_id is None or stripe_customer_id not in self.customer_ids:
+            return None
+
+        subscriptions_to_add, subscriptions_to_remove = self.diff(
+            user, self.subscriptions_by_customer.get(stripe_customer_id, [])
+        )
+        if not (subscriptions_to_add or subscriptions_to_remove):
+            return None
+
+        return {
+            "ref": user_ref,
+            "user": user,
+            "add": subscriptions_to_add,
+            "remove": subscriptions_to_remove,
+            "updateTime": update_time,
+        }
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "customers": len(self.customer_ids),
+            "subscriptions": sum(len(subs) for subs in self.subscriptions_by_customer.values()),
+            "users_scanned": self.users_scanned,
+            "users_updated": self.users_updated,
+            "users_per_second": round(self.users_scanned / elapsed, 1) if elapsed else 0.0,
+            "stripe_calls": self.stripe_calls,
+            "elapsed_seconds": round(elapsed, 3),
+        }
+
+
+class TokenBucket():
+    """Async token bucket whose refill rate backs off when Stripe throttles us."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        # The lock hands out tokens in arrival order
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def slow_down(self):
+        self.rate = max(1.0, self.rate / 2)
+
+    def recover(self):
+        # Creep back towards the configured rate after a throttle
+        self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+class ReconciliationRunner(ReconciliationEngine):
+    """Concurrent, rate-limit-aware version of the reconciliation engine.
+
+    Changes are committed through Firestore batches of ``batch_size`` users,
+    ``concurrency`` batches at a time. Every Stripe request takes a token
+    from a bucket refilled at ``stripe_rate`` per second, and 429 responses
+    halve that rate and retry with jittered backoff.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        concurrency: int = 16,
+        stripe_rate: float = 20.0,
+        max_retries: int = 5,
+        progress_interval: float = 10.0,
+        checkpoint_every: int = 500,
+        batch_size: int = 200,
+    ):
+        super().__init__(db)
+        self.concurrency = max(1, concurrency)
+        # Each user is at most three writes (two for the subscriptions and a
+        # referral credit), keeping a batch within Firestore's 500
+        self.batch_size = max(1, min(batch_size, Database.MAX_BATCH_WRITES // 3))
+        self.checkpoint_every = checkpoint_every
+        self.bucket = TokenBucket(stripe_rate)
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.throttles = 0
+        self.errors = 0
+
+        # Scan-ordered [user ID, done, failed] entries; the cursor is the
+        # last user ID with every user before it finished, and stops before
+        # the first user that failed so a resumed run retries it
+        self._scanned: deque[list] = deque()
+        self.cursor: str | None = None
+        self._failed = False
+
+    async def call_stripe(self, method, **params):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.stripe_calls += 1
+
+            try:
+                # Reads are retried by the policy on 5xx and timeouts, rate
+                # limits are left to the bucket below
+                result = await stripe_policy.call(method, idempotent=True, retryable=stripe_unavailable, **params)
+                self.bucket.recover()
+                return result
+
+            except stripe.error.RateLimitError:
+                self.throttles += 1
+                self.bucket.slow_down()
+                if attempt == self.max_retries:
+                    raise
+
+                await asyncio.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def _finish(self, entries: list[list], failed: bool = False):
+        for entry in entries:
+            entry[1] = True
+            entry[2] = failed
+
+        while self._scanned and self._scanned[0][1]:
+            user_id, _, failed = self._scanned.popleft()
+            self._failed = self._failed or failed
+            if not self._failed:
+                self.cursor = user_id
+
+    async def _retry_stale(self, change: dict) -> str | None:
+        # The user was updated after the scan read it, diff it again
+        snapshot = await self.db.get_user_snapshot(change["ref"], self.USER_FIELDS)
+        if not snapshot.exists:
+            return None
+
+        fresh = self.user_change(snapshot.reference, snapshot.to_dict() or {}, snapshot.update_time)
+        if fresh is None:
+            return None
+
+        results = await self.db.bulk_apply_subscription_changes([fresh])
+        return results[change["ref"].path]
+
+    async def _commit(self, pending: list[tuple[dict, list]], semaphore: asyncio.Semaphore):
+        try:
+            results = await self.db.bulk_apply_subscription_changes(
+                [change for change, _ in pending]
+            )
+            for change, entry in pending:
+                path = change["ref"].path
+                error = results.get(path)
+                if error == self.db.STALE_WRITE:
+                    try:
+                        error = await self._retry_stale(change)
+                    except Exception as retry_error:
+                        error = str(retry_error)
+
+                if error is None:
+                    self.users_updated += 1
+                    self._finish([entry])
+                else:
+                    self.errors += 1
+                    print(f"An error occurred reconciling {path}: {error}")
+                    self._finish([entry], failed=True)
+
+        except Exception as error:
+            self.errors += len(pending)
+            print(f"An error occurred committing a reconciliation batch: {error}")
+            self._finish([entry for _, entry in pending if not entry[1]], failed=True)
+
+        finally:
+            semaphore.release()
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            print(f"Reconciliation progress: {self.stats()}")
+
+    async def run(
+        self,
+        start_after: str | None = None,
+        checkpoint: Callable[[str], Awaitable[None]] | None = None,
+    ) -> dict:
+        """Reconcile users after ``start_after``, passing the cursor to
+        ``checkpoint`` every ``checkpoint_every`` users."""
+        self.started_at = time.monotonic()
+        self.cursor = start_after
+        reporter = asyncio.create_task(self._report_progress())
+
+        try:
+            await self.build_index()
+
+            # Acquire before creating each commit so at most `concurrency`
+            # batches are in flight and the scan doesn't run ahead of them
+            semaphore = asyncio.Semaphore(self.concurrency)
+            tasks = set()
+            pending = []
+            saved_cursor = start_after
+
+            async def commit_pending():
+                await semaphore.acquire()
+                task = asyncio.create_task(self._commit(pending, semaphore))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            async for user_doc in self.db.stream_users(self.USER_FIELDS, start_after=start_after):
+                self.users_scanned += 1
+
+                entry = [user_doc.id, False, False]
+                self._scanned.append(entry)
+
+                change = self.user_change(user_doc.reference, user_doc.to_dict(), user_doc.update_time)
+                if change is None:
+                    self._finish([entry])
+                else:
+                    pending.append((change, entry))
+                    if len(pending) >= self.batch_size:
+                        await commit_pending()
+                        pending = []
+
+                if checkpoint and self.users_scanned % self.checkpoint_every == 0 and self.cursor != saved_cursor:
+                    saved_cursor = self.cursor
+                    await checkpoint(saved_cursor)
+
+            if pending:
+                await commit_pending()
+
+            await asyncio.gather(*tasks)
+
+        finally:
+            reporter.cancel()
+
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "throttles": self.throttles,
+            "errors": self.errors,
+            "stripe_rate": round(self.bucket.rate, 2),
+        }
+
+
+class IncrementalReconciler():
+    """Replays Stripe events created since the last checkpoint.
+
+    Each event goes through the same handlers as its webhook, so only
+    what changed is applied. Events the webhooks already handled are
+    skipped through the event ledger.
+    """
+
+    EVENT_TYPES = [
+        "checkout.session.completed",
+        "customer.subscription.updated",
+        "customer.subscription.deleted",
+    ]
+
+    # Stripe only keeps events for 30 days, older checkpoints need a full scan
+    EVENT_RETENTION = timedelta(days=30)
+
+    def __init__(self, db: Database, call_stripe=None):
+        self.db = db
+        self.ledger = EventLedger(db)
+        self.call_stripe = call_stripe or ReconciliationEngine(db).call_stripe
+
+        # Progress counters
+        self.events_seen = 0
+        self.events_applied = 0
+        self.events_skipped = 0
+        self.events_failed = 0
+
+    @classmethod
+    def can_resume(cls, checkpoint: dict | None) -> bool:
+        if not checkpoint or checkpoint.get("created") is None:
+            return False
+
+        oldest = datetime.now(timezone.utc) - cls.EVENT_RETENTION + timedelta(hours=1)
+        return checkpoint["created"] > oldest.timestamp()
+
+    async def run(self, checkpoint: dict) -> dict:
+        """Apply events after ``checkpoint`` and return the new checkpoint.
+
+        A checkpoint holds the ``created`` timestamp of the last applied
+        event and the IDs of the events applied at that timestamp.
+        """
+        events = [
+            EventView.from_dict(event)
+            async for event in list_events(self.EVENT_TYPES, checkpoint["created"], self.call_stripe)
+        ]
+        events.sort(key=lambda event: (event.created, event.id))
+
+        created = checkpoint["created"]
+        event_ids = set(checkpoint.get("eventIds", []))
+
+        for event in events:
+            if event.created == created and event.id in event_ids:
+                continue
+
+            self.events_seen += 1
+            if await self.ledger.seen(event.id):
+                self.events_skipped += 1
+            else:
+                response = await handle_event(self.db, event)
+                status_code = 200 if response is None else response.status_code
+
+                # Stop on server errors so the event is retried next run
+                if status_code >= 500:
+                    self.events_failed += 1
+                    print(f"Failed to apply event {event.id} ({event.type}), stopping")
+                    break
+
+                if status_code < 300:
+                    self.events_applied += 1
+                    await self.ledger.mark_processed(event.id, event.type)
+                else:
+                    self.events_skipped += 1
+
+            if event.created != created:
+                created = event.created
+                event_ids = set()
+            event_ids.add(event.id)
+
+        return {"created": created, "eventIds": sorted(event_ids)}
+
+    def stats(self) -> dict:
+        return {
+            "events_seen": self.events_seen,
+            "events_applied": self.events_applied,
+            "events_skipped": self.events_skipped,
+            "events_failed": self.events_failed,
+        }
+
+
+async def run_reconciliation_job(
+    db: Database, restart: bool = False, incremental: bool = True, **runner_options
+) -> dict | None:
+    """Reconcile users with Stripe under the job lease.
+
+    Catches up from the Stripe events feed when a recent events checkpoint
+    exists, otherwise runs (or resumes) a full scan.
+    """
+    lease = JobLease(db, "reconciliation")
+    if not await lease.acquire():
+        print("Reconciliation is already running on another instance, skipping")
+        return None
+
+    keep_alive = asyncio.create_task(lease.keep_alive(asyncio.current_task()))
+    runner = ReconciliationRunner(db, **runner_options)
+
+    try:
+        state = {} if restart else await lease.load()
+
+        events_checkpoint = state.get("eventsCheckpoint")
+        if incremental and state.get("cursor") is None and IncrementalReconciler.can_resume(events_checkpoint):
+            reconciler = IncrementalReconciler(db, runner.call_stripe)
+            events_checkpoint = await reconciler.run(events_checkpoint)
+
+            stats = reconciler.stats()
+            await lease.save(
+                {
+                    "eventsCheckpoint": events_checkpoint,
+                    "completedAt": datetime.now(timezone.utc),
+                    "lastRun": stats,
+                }
+            )
+            return stats
+
+        cursor = state.get("cursor")
+        if cursor is not None:
+            print(f"Resuming reconciliation after user {cursor}")
+            scan_started_at = state.get("scanStartedAt")
+        else:
+            scan_started_at = int(datetime.now(timezone.utc).timestamp())
+            await lease.save({"scanStartedAt": scan_started_at})
+
+        async def checkpoint(cursor: str):
+            await lease.save({"cursor": cursor})
+
+        stats = await runner.run(start_after=cursor, checkpoint=checkpoint)
+
+        if runner.errors:
+            # Resume from the first failed user next time, with no events
+            # checkpoint so the retry is a scan rather than a catch-up
+            print(f"Reconciliation finished with {runner.errors} error(s), the next run retries from the first failed user")
+            await lease.save(
+                {
+                    "cursor": runner.cursor,
+                    "eventsCheckpoint": None,
+                    "completedAt": datetime.now(timezone.utc),
+                    "lastRun": stats,
+                }
+            )
+            return stats
+
+        # A finished scan starts from the beginning next time, and events
+        # since it started can be caught up incrementally
+        await lease.save(
+            {
+                "cursor": None,
+                "eventsCheckpoint": {"created": scan_started_at, "eventIds": []},
+                "completedAt": datetime.now(timezone.utc),
+                "lastRun": stats,
+            }
+        )
+        return stats
+
+    except asyncio.CancelledError:
+        # Keep the progress made so far for the next run, unless the job was
+        # stopped because another instance took over the lease
+        if runner.cursor is not None and not lease.lost:
+            await lease.save({"cursor": runner.cursor})
+        raise
+
+    finally:
+        keep_alive.cancel()
+        await lease.release()
+
+
+async def run_initial_subscription_check():
+    print("Running initial subscription check...")
+    db = Database()
+
+    try:
+        settings = get_settings()
+        stats = await run_reconciliation_job(
+            db,
+            incremental=settings.reconcile_mode == "incremental",
+            concurrency=settings.reconcile_concurrency,
+            stripe_rate=settings.reconcile_stripe_rate,
+        )
+        if stats is not None:
+            print(f"Subscription check finished: {stats}")
+
+    except asyncio.CancelledError:
+        print("Subscription check cancelled, progress saved")
+        raise
+
+    except Exception as error:
+        print(f"Error: {error}")
+        print(traceback.format_exc())
+
+
+async def main():
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="Reconcile user subscriptions with Stripe")
+    parser.add_argument("--concurrency", type=int, default=settings.reconcile_concurrency)
+    parser.add_argument("--stripe-rate", type=float, default=settings.reconcile_stripe_rate)
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoints")
+    parser.add_argument("--full", action="store_true", help="always run a full scan")
+    args = parser.parse_args()
+
+    setup_stripe(settings.stripe_api_key)
+    db = Database()
+    await db.open()
+
+    try:
+        stats = await run_reconciliation_job(
+            db,
+            restart=args.restart,
+            incremental=not args.full,
+            concurrency=args.concurrency,
+            stripe_rate=args.stripe_rate,
+        )
+        print(stats)
+
+    finally:
+        await db.close()
+        await close_stripe()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+# Local Imports
+from src.cache import TTLCache
+from src.lazy import lazy_import
+
+# External Imports
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+
+import traceback
+import hashlib
+import asyncio
+
+if TYPE_CHECKING:
+    from google.cloud.firestore_v1 import AsyncClient, AsyncDocumentReference
+
+firestore = lazy_import("google.cloud.firestore")
+
+
+class ReferralCredits():
+    """Credits referrers off the webhook path.
+
+    Each credit is a ``referral_credits`` document written in the same
+    transaction or batch as the subscription change that earned it, so it
+    survives a crash before the referrer is updated. Every ``interval``
+    seconds the pending credits are read back, merged per referrer into a
+    single ``ArrayUnion`` write and deleted in the same batch. Referral
+    code -> referrer reference lookups are cached, so repeat referrers cost
+    no query.
+    """
+
+    COLLECTION = "referral_credits"
+
+    # Firestore's limit on writes in one batch commit
+    MAX_BATCH_WRITES = 500
+
+    # Credits read per page, a referrer's write plus its credits' deletes
+    # always fit in one batch
+    PAGE_SIZE = 450
+
+    def __init__(self, db, interval: float = 5.0, maxsize: int = 10_000, ttl: float = 3600.0):
+        self.db = db
+        self.interval = interval
+        self._referrers = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._task: asyncio.Task | None = None
+        self._stopping: asyncio.Event | None = None
+
+        # Whether credits may be waiting, true at first so credits left by a
+        # stopped instance are picked up
+        self._queued = True
+
+        self.pending = 0
+        self.credited = 0
+        self.flushes = 0
+
+    @staticmethod
+    def pending_credit(client: AsyncClient, referral_code: str, user_id: str) -> tuple[AsyncDocumentReference, dict]:
+        """The document recording a credit, to be set with the change that earned it."""
+        # Keyed by the credit, so writing it again (a retried transaction,
+        # a repeat checkout) doesn't credit twice
+        key = hashlib.sha1(f"{referral_code}\0{user_id}".encode()).hexdigest()
+        doc_ref = client.collection(ReferralCredits.COLLECTION).document(key)
+        return doc_ref, {
+            "referralCode": referral_code,
+            "userId": user_id,
+            "createdAt": datetime.now(timezone.utc),
+        }
+
+    def notify(self):
+        # Called once a credit has been committed
+        self._queued = True
+        self.start()
+
+    async def lookup(self, referral_code: str) -> AsyncDocumentReference | None:
+        referrer_ref = self._referrers.get(referral_code)
+        if referrer_ref is not None:
+            return referrer_ref
+
+        client = await self.db.get_db_client()
+        # Only the reference is needed, so project the query to the document name
+        query = (
+            client.collection("users")
+            .where("referral.referralCode", "==", referral_code)
+            .select(["__name__"])
+            .limit(1)
+        )
+        async for doc in query.stream():
+            self._referrers.set(referral_code, doc.reference)
+            return doc.reference
+
+        return None
+
+    def evict(self, referral_code: str):
+        self._referrers.pop(referral_code)
+
+    async def _flush_page(self, client: AsyncClient) -> tuple[int, int, bool]:
+        """Write one page of credits, returns the referrers updated, the
+        credits left in place and whether the page was full."""
+        credits: dict[str, list] = defaultdict(list)
+        read = 0
+        async for doc in client.collection(self.COLLECTION).limit(self.PAGE_SIZE).stream():
+            read += 1
+            credits[(doc.to_dict() or {}).get("referralCode")].append(doc)
+
+        writes, left = [], 0
+        for referral_code, docs in credits.items():
+            try:
+                referrer_ref = await self.lookup(referral_code) if referral_code else None
+            except Exception as error:
+                # Left in place for the next flush
+                print(f"An error occurred looking up referral code {referral_code}: {error}")
+                left += len(docs)
+                continue
+
+            if referrer_ref is None:
+                print(f"Referrer not found for referral code {referral_code}, dropping {len(docs)} credit(s)")
+            writes.append((referral_code, referrer_ref, docs))
+
+        # A referrer's write and its credits' deletes share a batch, so
+        # credits are never both applied and kept
+        chunks, chunk, chunk_writes = [], [], 0
+        for write in writes:
+            size = 1 + len(write[2])
+            if chunk and chunk_writes + size > self.MAX_BATCH_WRITES:
+                chunks.append(chunk)
+                chunk, chunk_writes = [], 0
+
+            chunk.append(write)
+            chunk_writes += size
+
+        if chunk:
+            chunks.append(chunk)
+
+        updated = 0
+        for chunk in chunks:
+            batch = client.batch()
+            for _, referrer_ref, docs in chunk:
+                user_ids = sorted({(doc.to_dict() or {}).get("userId") for doc in docs} - {None})
+                if referrer_ref is not None and user_ids:
+                    batch.update(referrer_ref, {"referral.validReferrals": firestore.ArrayUnion(user_ids)})
+                for doc in docs:
+                    batch.delete(doc.reference)
+
+            try:
+                await batch.commit()
+                updated += sum(referrer_ref is not None for _, referrer_ref, _ in chunk)
+
+            except Exception as error:
+                # Drop cached references that may be stale, the credits stay
+                # for the next flush
+                print(f"An error occurred in flush(): {error}")
+                for referral_code, _, docs in chunk:
+                    self.evict(referral_code)
+                    left += len(docs)
+
+        return updated, left, read == self.PAGE_SIZE
+
+    async def flush(self) -> int:
+        """Write every pending credit, returns the number of referrers updated."""
+        if not self._queued:
+            return 0
+
+        self._queued = False
+        client = await self.db.get_db_client()
+
+        updated = 0
+        try:
+            while True:
+                page_updated, self.pending, full = await self._flush_page(client)
+                updated += page_updated
+                if self.pending:
+                    self._queued = True
+                # Credits that couldn't be written would be read again
+                if not full or self.pending:
+                    break
+
+        except BaseException:
+            self._queued = True
+            raise
+
+        self.credited += updated
+        self.flushes += 1
+        return updated
+
+    async def _run(self):
+        # Stopped through the event rather than cancelled, so a flush in
+        # progress always completes
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+            except Exception as error:
+                print(f"An error occurred flushing referral credits: {error}")
+                print(traceback.format_exc())
+
+    def start(self):
+        # Also called on the first credit, lazy mode never opens the database
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="referral-credits")
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        # Write whatever is still pending, the rest is kept for the next start
+        await self.flush()
+        if self.pending:
+            print(f"Referral credits left for the next flush: {self.pending}")
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "credited": self.credited,
+            "flushes": self.flushes,
+            "referrers": self._referrers.stats(),
+        }
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+# Local Imports
+from src.exceptions import CircuitOpenError
+from src.config import get_settings
+from src.metrics import metrics
+from src.lazy import lazy_import
+
+# External Imports
+from typing import Any, Awaitable, Callable
+
+import asyncio
+import random
+import math
+import time
+
+stripe = lazy_import("stripe")
+api_exceptions = lazy_import("google.api_core.exceptions")
+
+
+class CircuitBreaker():
+    """Stops calls to a dependency after ``failure_threshold`` failures in a row.
+
+    While open every call is rejected straight away. Once ``reset_timeout``
+    has passed a single trial call is let through (half open), its result
+    closes the circuit again or reopens it.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CircuitBreaker.CLOSED
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return CircuitBreaker.OPEN
+        return CircuitBreaker.HALF_OPEN
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead, a half open circuit allows one at a time."""
+        state = self.state
+        if state == CircuitBreaker.CLOSED:
+            return True
+
+        if state == CircuitBreaker.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> int:
+        """Whole seconds until an open circuit lets a trial call through."""
+        if self.opened_at is None:
+            return 0
+        return max(1, math.ceil(self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self._trial = False
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.state != CircuitBreaker.OPEN:
+                self.trips += 1
+                print(f"The {self.name} circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # A cancelled trial call proved nothing, let the next one try
+        self._trial = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class CallPolicy():
+    """Deadlines, retries and a circuit breaker for calls to one dependency.
+
+    Each attempt is cancelled after ``timeout`` seconds and every attempt
+    must start within ``deadline`` seconds of the first. Only calls marked
+    idempotent are retried, with jittered exponential backoff, and only
+    for errors ``retryable`` accepts (which a call can override). Errors ``unavailable`` accepts count
+    against the circuit breaker, any other outcome shows the dependency is
+    up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        unavailable: Callable[[BaseException], bool],
+        retryable: Callable[[BaseException], bool],
+        timeout: float = 10.0,
+        deadline: float = 20.0,
+        retries: int = 2,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self.name = name
+        self.unavailable = unavailable
+        self.retryable = retryable
+        self.timeout = timeout
+        self.deadline = max(deadline, timeout)
+        self.retries = max(0, retries)
+        self.breaker = breaker or CircuitBreaker(name)
+
+    def available(self) -> bool:
+        """False while the circuit is open, without taking the trial call."""
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    async def call(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        idempotent: bool = False,
+        retryable: Callable[[BaseException], bool] | None = None,
+        **kwargs,
+    ) -> Any:
+        retryable = retryable or self.retryable
+        attempts = self.retries + 1 if idempotent else 1
+        deadline = time.monotonic() + self.deadline
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                metrics.inc("payments_dependency_rejected_total", dependency=self.name)
+                raise CircuitOpenError(f"The {self.name} circuit is open")
+
+            settled = False
+            try:
+                timeout = min(self.timeout, deadline - time.monotonic())
+                result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+                settled = True
+                self.breaker.record_success()
+                return result
+
+            except Exception as error:
+                settled = True
+                if self.unavailable(error):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+                if isinstance(error, TimeoutError):
+                    metrics.inc("payments_dependency_timeouts_total", dependency=self.name)
+
+                delay = min(5.0, 0.2 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                last_attempt = attempt == attempts - 1 or time.monotonic() + delay >= deadline
+                if last_attempt or not retryable(error):
+                    raise
+
+                metrics.inc("payments_dependency_retries_total", dependency=self.name)
+                print(f"Retrying {self.name} call after {type(error).__name__}: {error}")
+                await asyncio.sleep(delay)
+
+            finally:
+                if not settled:
+                    self.breaker.release()
+
+
+def stripe_unavailable(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, stripe.APIConnectionError):
+        return True
+    return isinstance(error, stripe.StripeError) and (error.http_status or 0) >= 500
+
+
+def stripe_retryable(error: BaseException) -> bool:
+    # Rate limits are retried but don't open the circuit, a throttled
+    # reconciliation must not stop webhooks
+    return stripe_unavailable(error) or isinstance(error, stripe.RateLimitError)
+
+
+def firestore_unavailable(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # 5xx, including UNAVAILABLE and DEADLINE_EXCEEDED
+    return isinstance(error, api_exceptions.ServerError)
+
+
+def firestore_retryable(error: BaseException) -> bool:
+    # RESOURCE_EXHAUSTED is a TooManyRequests
+    return firestore_unavailable(error) or isinstance(error, api_exceptions.TooManyRequests)
+
+
+def _policy(name: str, unavailable, retryable, timeout: float, deadline: float) -> CallPolicy:
+    settings = get_settings()
+    return CallPolicy(
+        name,
+        unavailable,
+        retryable,
+        timeout=timeout,
+        deadline=deadline,
+        retries=settings.dependency_retries,
+        breaker=CircuitBreaker(name, settings.circuit_failure_threshold, settings.circuit_reset_seconds),
+    )
+
+
+_settings = get_settings()
+
+stripe_policy = _policy(
+    "stripe", stripe_unavailable, stripe_retryable, _settings.stripe_timeout, _settings.stripe_deadline
+)
+firestore_policy = _policy(
+    "firestore", firestore_unavailable, firestore_retryable, _settings.firestore_timeout, _settings.firestore_deadline
+)
+
+POLICIES = {policy.name: policy for policy in (stripe_policy, firestore_policy)}
+
+# Exported as a gauge, 0 closed, 1 half open, 2 open
+CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+def circuit_stats() -> dict[str, dict]:
+    return {name: policy.breaker.stats() for name, policy in POLICIES.items()}
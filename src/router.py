@@ -0,0 +1,103 @@
+# Local Imports
+from src.exceptions import SignatureVerificationError
+from src.events import EventView, parse_event
+from src.ratelimit import RateLimiter
+from src.metrics import metrics
+
+# External Imports
+from fastapi.responses import JSONResponse
+from fastapi import Request
+from typing import Any, Awaitable, Callable
+
+# Handlers take the verified event and return a response, or None for a 200
+EventHandler = Callable[[EventView], Awaitable[Any]]
+
+
+class WebhookRouter():
+    """Verifies Stripe webhooks and dispatches them by event type.
+
+    The payload's signature is checked against every configured endpoint
+    secret, so one route can serve several Stripe endpoints and a secret
+    can be rolled without downtime. Event types with no registered handler
+    are acknowledged with a 200 straight after verification, so Stripe
+    doesn't retry them.
+    """
+
+    def __init__(self, secrets: list[str], tolerance: int = 300, limiter: RateLimiter | None = None):
+        self.secrets = list(secrets)
+        self.tolerance = tolerance
+        self.limiter = limiter
+        self.handlers: dict[str, EventHandler] = {}
+
+    def register(self, event_types: str | list[str], handler: EventHandler):
+        if isinstance(event_types, str):
+            event_types = [event_types]
+
+        for event_type in event_types:
+            self.handlers[event_type] = handler
+
+    async def dispatch(self, request: Request):
+        if not self.secrets:
+            print("No webhook secrets configured")
+            return JSONResponse(
+                content={"message": "Webhook secrets are not configured"},
+                status_code=500,
+            )
+
+        try:
+            # The signature is checked over the raw bytes, which are then
+            # decoded straight into a compact event view
+            payload = await request.body()
+            sig_header = request.headers.get("stripe-signature")
+            with metrics.span("verify_signature"):
+                event = parse_event(payload, sig_header, self.secrets, self.tolerance)
+
+        except ValueError as error:
+            # Invalid payload
+            print("Value error", error)
+            return JSONResponse(
+                content={
+                    "message": "Failed to create event, Invalid Payload",
+                    "error": str(error),
+                },
+                status_code=400,
+            )
+        except SignatureVerificationError as error:
+            # Invalid signature
+            print("SignatureVerificationError", error)
+
+            # Only senders of bad signatures are ever limited by address, a
+            # valid event is handled whatever else came from its address
+            client_ip = request.client.host if request.client else None
+            if self.limiter is not None:
+                await self.limiter.record_invalid(client_ip)
+                if await self.limiter.blocked(client_ip):
+                    return JSONResponse(
+                        content={"detail": "Too many invalid signatures, please try again later."},
+                        status_code=429,
+                    )
+
+            return JSONResponse(
+                content={
+                    "message": "Failed to create event, Invalid Signature",
+                    "error": str(error),
+                },
+                status_code=400,
+            )
+
+        metrics.tag(event)
+        handler = self.handlers.get(event.type)
+        if handler is None:
+            return JSONResponse(
+                content={"message": f"Ignored event type {event.type}", "event": event.id},
+                status_code=200,
+            )
+
+        response = await handler(event)
+        if response is not None:
+            return response
+
+        return JSONResponse(
+            content={"message": "Event processed", "event": event.id},
+            status_code=200,
+        )
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+# Local Imports
+from src.resilience import stripe_policy
+from src.metrics import metrics
+from src.lazy import lazy_import
+
+# External Imports
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+# The stripe SDK is the heaviest import, load it on the first API call
+stripe = lazy_import("stripe")
+
+_api_key: str | None = None
+_configured = False
+
+
+def setup_stripe(api_key: str | None):
+    """Set the API key, the SDK itself is configured on first use."""
+    global _api_key, _configured
+    _api_key = api_key
+    _configured = False
+
+
+def _configure():
+    global _configured
+    if _configured:
+        return
+
+    stripe.api_key = _api_key
+
+    # Every *_async call shares this client's connection pool, so requests
+    # never block the event loop and keep-alive connections are reused
+    if not isinstance(stripe.default_http_client, stripe.HTTPXClient):
+        stripe.default_http_client = stripe.HTTPXClient()
+
+    _configured = True
+
+
+async def close_stripe():
+    global _configured
+    if not _configured:
+        return
+
+    _configured = False
+    if stripe.default_http_client is None:
+        return
+
+    try:
+        await stripe.default_http_client.close_async()
+    except Exception as error:
+        print(f"An error occurred in close_stripe(): {error}")
+    finally:
+        stripe.default_http_client = None
+
+
+async def retrieve_subscription(subscription_id: str) -> stripe.Subscription:
+    _configure()
+    with metrics.span("stripe.retrieve_subscription", dependency="stripe"):
+        return await stripe_policy.call(stripe.Subscription.retrieve_async, subscription_id, idempotent=True)
+
+
+async def retrieve_price(price_id: str) -> stripe.Price:
+    _configure()
+    with metrics.span("stripe.retrieve_price", dependency="stripe"):
+        return await stripe_policy.call(stripe.Price.retrieve_async, price_id, idempotent=True)
+
+
+async def _direct_call(method: Callable[..., Awaitable[Any]], **params) -> Any:
+    # List pages are reads, so they can be retried
+    return await stripe_policy.call(method, idempotent=True, **params)
+
+
+def _list_method(resource: str) -> Callable[..., Awaitable[stripe.ListObject]]:
+    _configure()
+    return getattr(stripe, resource).list_async
+
+
+async def paginate(
+    method: Callable[..., Awaitable[stripe.ListObject]],
+    call: Callable[..., Awaitable[Any]] = _direct_call,
+    **params,
+) -> AsyncIterator[Any]:
+    """Yield every item of a Stripe list, one page request at a time.
+
+    ``call`` wraps each page request, letting callers throttle or count them.
+    """
+    params.setdefault("limit", 100)
+    while True:
+        page = await call(method, **params)
+        for item in page["data"]:
+            yield item
+
+        if not page["has_more"] or not page["data"]:
+            return
+
+        params["starting_after"] = page["data"][-1]["id"]
+
+
+def list_all_subscriptions(call=_direct_call) -> AsyncIterator[stripe.Subscription]:
+    # Expanding the product saves a Product.retrieve per subscription
+    return paginate(_list_method("Subscription"), call, expand=["data.plan.product"])
+
+
+async def list_customer_ids(call=_direct_call) -> AsyncIterator[str]:
+    async for customer in paginate(_list_method("Customer"), call):
+        yield customer["id"]
+
+
+def list_events(types: list[str], since: int, call=_direct_call) -> AsyncIterator[stripe.Event]:
+    # Stripe returns events newest first
+    return paginate(_list_method("Event"), call, types=types, created={"gte": since})
+
+
+def list_prices(call=_direct_call) -> AsyncIterator[stripe.Price]:
+    return paginate(_list_method("Price"), call, active=True)
@@ -0,0 +1,53 @@
+# Local Imports
+
+
+# External Imports
+
+
+# Layouts of the ``subscriptions`` field on a user document:
+# "array" holds a list of entries, "map" keys each entry by its product ID
+# so it can be written or deleted by field path without reading first
+ARRAY = "array"
+MAP = "map"
+
+
+def layout_of(user: dict) -> str:
+    return MAP if isinstance(user.get("subscriptions"), dict) else ARRAY
+
+
+def subscription_list(user: dict) -> list[dict]:
+    """A user's subscriptions as a list, whichever layout they are stored in."""
+    subscriptions = user.get("subscriptions") or []
+    if isinstance(subscriptions, dict):
+        return list(subscriptions.values())
+    return list(subscriptions)
+
+
+def subscription_path(product_id: str) -> str:
+    # Imported here, finding a submodule's spec would import the whole
+    # firestore package at startup
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    # Quoted when needed, product IDs are not guaranteed to be plain identifiers
+    return FieldPath("subscriptions", product_id).to_api_repr()
+
+
+def subscribed_name(subscription: dict) -> str:
+    # e.g. "Pro - member" -> "pro", stored in authentication.subscribed
+    name: str = subscription.get("name") or ""
+    return name.replace(" - member", "").lower()
+
+
+def member_subscription(subscriptions: list[dict]) -> dict | None:
+    for sub in subscriptions:
+        if "member" in (sub.get("name") or ""):
+            return sub
+    return None
+
+
+def to_map(subscriptions: list[dict]) -> dict[str, dict]:
+    # The first entry for a product wins, as ArrayUnion would have kept it
+    keyed = {}
+    for sub in subscriptions:
+        keyed.setdefault(sub["id"], sub)
+    return keyed
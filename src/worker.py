@@ -0,0 +1,139 @@
+# Local Imports
+
+
+# External Imports
+from typing import Any, Awaitable, Callable
+
+import traceback
+import asyncio
+import random
+import zlib
+
+
+class EventQueue():
+    """Bounded queue of webhook events processed by a pool of asyncio workers.
+
+    Each worker owns one shard and an item's key (the Stripe customer ID)
+    always maps to the same shard, so events for one customer are handled
+    in the order they were submitted. A failing item is retried in place
+    with backoff, keeping that order, and once ``retries`` are used up it
+    is passed to ``on_failure`` so it can be recorded.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int = 4,
+        maxsize: int = 1000,
+        retries: int = 3,
+        on_failure: Callable[[Any, Exception], Awaitable[Any]] | None = None,
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.retries = max(0, retries)
+        self.on_failure = on_failure
+
+        # Split the capacity across the shards
+        shard_size = max(1, maxsize // self.workers)
+        self._shards = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks: list[asyncio.Task] = []
+
+        # Backpressure counters
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def _shard_for(self, key: str | None) -> asyncio.Queue:
+        # crc32 is stable across processes, unlike hash()
+        index = zlib.crc32((key or "").encode()) % self.workers
+        return self._shards[index]
+
+    def start(self):
+        if self._tasks:
+            return
+
+        self._tasks = [
+            asyncio.create_task(self._run(shard), name=f"event-worker-{index}")
+            for index, shard in enumerate(self._shards)
+        ]
+
+    def submit(self, key: str | None, item: Any) -> bool:
+        """Queue an item, returns False when its shard is full."""
+        try:
+            self._shard_for(key).put_nowait(item)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        return True
+
+    async def _handle(self, item: Any):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.handler(item)
+
+            except Exception as error:
+                if attempt == self.retries:
+                    raise
+
+                self.retried += 1
+                print(f"Retrying a queued item after an error: {error}")
+                await asyncio.sleep(min(10.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    async def _run(self, shard: asyncio.Queue):
+        while True:
+            item = await shard.get()
+            try:
+                if item is None:
+                    return
+
+                await self._handle(item)
+                self.processed += 1
+
+            except Exception as error:
+                self.failed += 1
+                print(f"An error occurred in the event worker: {error}")
+                print(traceback.format_exc())
+
+                if self.on_failure is not None:
+                    try:
+                        await self.on_failure(item, error)
+                    except Exception as failure_error:
+                        print(f"An error occurred recording a failed item: {failure_error}")
+
+            finally:
+                shard.task_done()
+
+    async def stop(self):
+        """Drain every queued item, then stop the workers."""
+        if not self._tasks:
+            return
+
+        # The sentinel lands behind anything already queued
+        for shard in self._shards:
+            await shard.put(None)
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return sum(shard.qsize() for shard in self._shards)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "capacity": self.maxsize,
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rejected": self.rejected,
+        }
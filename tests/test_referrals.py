@@ -0,0 +1,173 @@
+"""Pending referral credits are durable documents until their referrer is updated."""
+
+# Local Imports
+from src.referrals import ReferralCredits
+
+# External Imports
+import asyncio
+
+
+class StubSnapshot():
+    def __init__(self, reference, data: dict):
+        self.reference = reference
+        self._data = data
+
+    def to_dict(self) -> dict:
+        return dict(self._data)
+
+
+class StubDocument():
+    def __init__(self, client: "StubClient", path: str):
+        self.client = client
+        self.path = path
+
+
+class StubQuery():
+    def __init__(self, client: "StubClient", name: str, limit: int | None = None):
+        self.client = client
+        self.name = name
+        self._limit = limit
+
+    def limit(self, count: int) -> "StubQuery":
+        return StubQuery(self.client, self.name, count)
+
+    def document(self, document_id: str) -> StubDocument:
+        return StubDocument(self.client, f"{self.name}/{document_id}")
+
+    async def stream(self):
+        paths = sorted(path for path in self.client.documents if path.startswith(f"{self.name}/"))
+        for path in paths[:self._limit]:
+            yield StubSnapshot(StubDocument(self.client, path), self.client.documents[path])
+
+
+class StubBatch():
+    def __init__(self, client: "StubClient"):
+        self.client = client
+        self.operations = []
+
+    def set(self, doc_ref: StubDocument, data: dict):
+        self.operations.append(("set", doc_ref.path, data))
+
+    def update(self, doc_ref: StubDocument, data: dict):
+        self.operations.append(("update", doc_ref.path, data))
+
+    def delete(self, doc_ref: StubDocument):
+        self.operations.append(("delete", doc_ref.path, None))
+
+    async def commit(self):
+        if self.client.fail_commits:
+            self.client.fail_commits -= 1
+            raise RuntimeError("Commit failed")
+
+        # All or nothing, like a WriteBatch
+        for operation, path, data in self.operations:
+            if operation == "set":
+                self.client.documents[path] = dict(data)
+            elif operation == "delete":
+                self.client.documents.pop(path, None)
+            else:
+                referred = self.client.referred.setdefault(path, set())
+                referred.update(data["referral.validReferrals"].values)
+
+
+class StubClient():
+    def __init__(self):
+        self.documents: dict[str, dict] = {}
+        self.referred: dict[str, set] = {}
+        self.fail_commits = 0
+
+    def collection(self, name: str) -> StubQuery:
+        return StubQuery(self, name)
+
+    def batch(self) -> StubBatch:
+        return StubBatch(self)
+
+
+class StubDatabase():
+    def __init__(self, client: StubClient):
+        self.client = client
+
+    async def get_db_client(self) -> StubClient:
+        return self.client
+
+
+def credits_with(client: StubClient, *credits: tuple[str, str]) -> ReferralCredits:
+    referrals = ReferralCredits(StubDatabase(client))
+
+    async def lookup(referral_code: str):
+        return None if referral_code == "unknown" else StubDocument(client, f"users/{referral_code}")
+
+    referrals.lookup = lookup
+
+    # Written as the subscription change would have written them
+    batch = client.batch()
+    for referral_code, user_id in credits:
+        batch.set(*ReferralCredits.pending_credit(client, referral_code, user_id))
+    asyncio.run(batch.commit())
+    return referrals
+
+
+def pending(client: StubClient) -> int:
+    return sum(path.startswith(f"{ReferralCredits.COLLECTION}/") for path in client.documents)
+
+
+def test_pending_credit_is_keyed_by_the_credit():
+    client = StubClient()
+    first, _ = ReferralCredits.pending_credit(client, "code_1", "user_1")
+    again, _ = ReferralCredits.pending_credit(client, "code_1", "user_1")
+    other, _ = ReferralCredits.pending_credit(client, "code_1", "user_2")
+
+    assert first.path == again.path
+    assert first.path != other.path
+
+
+def test_flush_credits_referrers_and_deletes_the_credits():
+    client = StubClient()
+    referrals = credits_with(client, ("code_1", "user_1"), ("code_1", "user_2"), ("code_2", "user_3"))
+
+    assert asyncio.run(referrals.flush()) == 2
+    assert client.referred == {"users/code_1": {"user_1", "user_2"}, "users/code_2": {"user_3"}}
+    assert pending(client) == 0
+
+
+def test_failed_commit_keeps_the_credits():
+    client = StubClient()
+    referrals = credits_with(client, ("code_1", "user_1"))
+    client.fail_commits = 1
+
+    assert asyncio.run(referrals.flush()) == 0
+    assert client.referred == {}
+    assert pending(client) == 1
+    assert referrals.stats()["pending"] == 1
+
+    assert asyncio.run(referrals.flush()) == 1
+    assert client.referred == {"users/code_1": {"user_1"}}
+    assert pending(client) == 0
+
+
+def test_credits_left_by_another_instance_are_flushed():
+    client = StubClient()
+    credits_with(client, ("code_1", "user_1"))
+
+    # A fresh instance checks for pending credits on its first flush
+    referrals = credits_with(client)
+    assert asyncio.run(referrals.flush()) == 1
+    assert client.referred == {"users/code_1": {"user_1"}}
+
+
+def test_unknown_referrer_drops_the_credit():
+    client = StubClient()
+    referrals = credits_with(client, ("unknown", "user_1"))
+
+    assert asyncio.run(referrals.flush()) == 0
+    assert client.referred == {}
+    assert pending(client) == 0
+
+
+def test_flush_reads_every_page():
+    client = StubClient()
+    credits = [(f"code_{index}", f"user_{index}") for index in range(ReferralCredits.PAGE_SIZE + 10)]
+    referrals = credits_with(client, *credits)
+
+    assert asyncio.run(referrals.flush()) == len(credits)
+    assert pending(client) == 0
@@ -0,0 +1,312 @@
+"""The array and map subscription layouts must behave the same.
+
+Every write path runs against a stubbed Firestore client that applies
+updates the way Firestore does (field paths, DELETE_FIELD, ArrayUnion,
+ArrayRemove), and the resulting documents are compared across layouts.
+"""
+
+# Local Imports
+from src.subscriptions import ARRAY, MAP, subscription_list, to_map
+from src.database import Database
+import src.database
+
+# External Imports
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud import firestore
+
+import asyncio
+import copy
+import pytest
+
+LAYOUTS = [ARRAY, MAP]
+
+
+def entry(product_id: str, name: str, override: bool = False) -> dict:
+    return {"id": product_id, "name": name, "override": override, "createdAt": "2024-01-01T00:00:00"}
+
+
+def apply_update(data: dict, update: dict):
+    for path, value in update.items():
+        *parents, field = FieldPath.from_string(path).parts
+        node = data
+        for part in parents:
+            node = node.setdefault(part, {})
+
+        if value is firestore.DELETE_FIELD:
+            node.pop(field, None)
+        elif isinstance(value, firestore.ArrayUnion):
+            current = node.setdefault(field, [])
+            current.extend(item for item in value.values if item not in current)
+        elif isinstance(value, firestore.ArrayRemove):
+            node[field] = [item for item in node.get(field, []) if item not in value.values]
+        else:
+            node[field] = copy.deepcopy(value)
+
+
+def project(data: dict, field_paths: list[str] | None) -> dict:
+    if field_paths is None:
+        return copy.deepcopy(data)
+
+    projected = {}
+    for path in field_paths:
+        *parents, field = FieldPath.from_string(path).parts
+        source, target = data, projected
+        for part in parents:
+            source = source.get(part) if isinstance(source, dict) else None
+            target = target.setdefault(part, {})
+        if isinstance(source, dict) and field in source:
+            target[field] = copy.deepcopy(source[field])
+    return projected
+
+
+class StubSnapshot():
+    def __init__(self, data: dict | None):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict | None:
+        return self._data
+
+
+class StubDocument():
+    def __init__(self, data: dict | None):
+        self.data = data
+        self.path = "users/user_1"
+        self.writes = []
+        self.reads = 0
+
+    async def get(self, field_paths=None, transaction=None):
+        self.reads += 1
+        return StubSnapshot(None if self.data is None else project(self.data, field_paths))
+
+    async def update(self, update: dict):
+        if self.data is None:
+            raise src.database.api_exceptions.NotFound("No document to update")
+        self.writes.append(update)
+        apply_update(self.data, update)
+
+
+class StubTransaction():
+    def update(self, user_ref: StubDocument, update: dict):
+        user_ref.writes.append(update)
+        apply_update(user_ref.data, update)
+
+    def set(self, doc_ref: StubDocument, data: dict):
+        doc_ref.data = copy.deepcopy(data)
+
+
+class StubClient():
+    def __init__(self):
+        self.documents: dict[str, StubDocument] = {}
+
+    def transaction(self):
+        return StubTransaction()
+
+    def collection(self, name: str):
+        client = self
+
+        class Collection():
+            def document(self, document_id: str) -> StubDocument:
+                return client.documents.setdefault(f"{name}/{document_id}", StubDocument(None))
+
+        return Collection()
+
+    def credits(self) -> list[tuple[str, str]]:
+        return [
+            (doc.data["referralCode"], doc.data["userId"])
+            for path, doc in self.documents.items()
+            if path.startswith("referral_credits/") and doc.data is not None
+        ]
+
+
+class StubCredits():
+    def __init__(self):
+        self.notified = 0
+
+    def notify(self):
+        self.notified += 1
+
+
+@pytest.fixture
+def client():
+    return StubClient()
+
+
+@pytest.fixture
+def database(monkeypatch, client):
+    async def get_db_client(self):
+        return client
+
+    # Transactions run once, as they would without contention
+    monkeypatch.setattr(src.database.firestore, "async_transactional", lambda func: func)
+    monkeypatch.setattr(Database, "get_db_client", get_db_client)
+    monkeypatch.setattr(Database, "_referral_credits", StubCredits())
+    return Database()
+
+
+def use_layout(monkeypatch, layout: str):
+    monkeypatch.setattr(Database, "_layout", staticmethod(lambda: layout))
+
+
+def user_document(layout: str, subscriptions: list[dict], subscribed: str | None = None) -> StubDocument:
+    data = {
+        "id": "user_1",
+        "subscriptions": to_map(subscriptions) if layout == MAP else list(subscriptions),
+        "referral": {"referredBy": "code_1"},
+    }
+    if subscribed is not None:
+        data["authentication"] = {"subscribed": subscribed}
+    return StubDocument(copy.deepcopy(data))
+
+
+def state(user_ref: StubDocument) -> tuple[list[dict], str | None]:
+    subscriptions = sorted(subscription_list(user_ref.data), key=lambda sub: sub["id"])
+    return subscriptions, user_ref.data.get("authentication", {}).get("subscribed")
+
+
+def test_fold_step_add_keeps_an_existing_entry():
+    existing = entry("prod_pro", "Pro - member", override=True)
+    subscriptions = [existing]
+
+    matched, subscribed = Database._fold_step(subscriptions, "add", entry("prod_pro", "Pro - member"))
+
+    assert matched
+    assert subscribed == "pro"
+    assert subscriptions == [existing]
+
+
+def test_fold_step_swap_keeps_an_overridden_member():
+    overridden = entry("prod_pro", "Pro - member", override=True)
+    subscriptions = [overridden]
+
+    matched, subscribed = Database._fold_step(subscriptions, "swap", entry("prod_std", "Standard - member"))
+
+    assert matched
+    assert subscribed == "standard"
+    assert subscriptions == [overridden, entry("prod_std", "Standard - member")]
+
+
+def test_fold_step_swap_without_a_member_matches_nothing():
+    subscriptions = [entry("prod_addon", "Addon")]
+
+    assert Database._fold_step(subscriptions, "swap", entry("prod_std", "Standard - member")) == (False, None)
+    assert subscriptions == [entry("prod_addon", "Addon")]
+
+
+def test_fold_step_remove():
+    subscriptions = [entry("prod_pro", "Pro - member"), entry("prod_admin", "admin", override=True)]
+
+    assert Database._fold_step(subscriptions, "remove", entry("prod_pro", "Pro - member")) == (True, firestore.DELETE_FIELD)
+    assert Database._fold_step(subscriptions, "remove", entry("prod_admin", "admin")) == (True, None)
+    assert Database._fold_step(subscriptions, "remove", entry("prod_gone", "Gone")) == (False, None)
+    assert subscriptions == [entry("prod_admin", "admin", override=True)]
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_apply_subscription_steps(database, client, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+    user_ref = user_document(layout, [entry("prod_pro", "Pro - member"), entry("prod_addon", "Addon", override=True)], "pro")
+    steps = [
+        ("swap", entry("prod_std", "Standard - member")),
+        ("remove", entry("prod_addon", "Addon")),
+        ("remove", entry("prod_gone", "Gone")),
+    ]
+
+    matched = asyncio.run(database.apply_subscription_steps(user_ref, steps))
+
+    assert matched == [True, True, False]
+    assert state(user_ref) == (
+        [entry("prod_addon", "Addon", override=True), entry("prod_std", "Standard - member")],
+        "standard",
+    )
+    assert len(user_ref.writes) == 1
+    assert client.credits() == [("code_1", "user_1")]
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_subscription_change_writes(layout):
+    current = [entry("prod_pro", "Pro - member"), entry("prod_addon", "Addon")]
+    user_ref = user_document(layout, current, "pro")
+    change = {
+        "user": copy.deepcopy(user_ref.data),
+        "add": [entry("prod_std", "Standard - member")],
+        "remove": [entry("prod_pro", "Pro - member")],
+    }
+
+    for update in Database._subscription_change_writes(change):
+        apply_update(user_ref.data, update)
+
+    assert state(user_ref) == ([entry("prod_addon", "Addon"), entry("prod_std", "Standard - member")], "standard")
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_subscription_change_writes_removal_clears_subscribed(layout):
+    user_ref = user_document(layout, [entry("prod_pro", "Pro - member")], "pro")
+    change = {"user": copy.deepcopy(user_ref.data), "add": [], "remove": [entry("prod_pro", "Pro - member")]}
+
+    for update in Database._subscription_change_writes(change):
+        apply_update(user_ref.data, update)
+
+    assert state(user_ref) == ([], None)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_add_subscriptions_keeps_existing_entries(database, client, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+    overridden = entry("prod_pro", "Pro - member", override=True)
+    user_ref = user_document(layout, [overridden])
+
+    added = asyncio.run(database.add_subscriptions(
+        user_ref, [entry("prod_pro", "Pro - member"), entry("prod_addon", "Addon")]
+    ))
+
+    assert added
+    assert state(user_ref) == ([entry("prod_addon", "Addon"), overridden], "pro")
+    assert client.credits() == [("code_1", "user_1")]
+    assert Database._referral_credits.notified == 1
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_add_subscriptions_to_a_missing_user(database, client, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+
+    assert not asyncio.run(database.add_subscriptions(StubDocument(None), [entry("prod_pro", "Pro - member")]))
+    assert client.credits() == []
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_remove_subscriptions(database, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+    user_ref = user_document(layout, [entry("prod_pro", "Pro - member"), entry("prod_addon", "Addon")], "pro")
+
+    asyncio.run(database.remove_subscriptions(user_ref, [entry("prod_pro", "Pro - member")]))
+
+    assert state(user_ref) == ([entry("prod_addon", "Addon")], None)
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_remove_absent_subscription_keeps_subscribed(database, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+    user_ref = user_document(layout, [entry("prod_pro", "Pro - member")], "pro")
+
+    asyncio.run(database.remove_subscriptions(user_ref, [entry("prod_gone", "Gone")]))
+
+    assert state(user_ref) == ([entry("prod_pro", "Pro - member")], "pro")
+    assert user_ref.writes == []
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_delete_subscription(database, monkeypatch, layout):
+    use_layout(monkeypatch, layout)
+    user_ref = user_document(layout, [entry("prod_pro", "Pro - member"), entry("prod_addon", "Addon")], "pro")
+
+    asyncio.run(database.delete_subscription(user_ref, "prod_pro"))
+
+    assert state(user_ref) == ([entry("prod_addon", "Addon")], None)
+    if layout == MAP:
+        # Deleted by path in one write, with no read
+        assert user_ref.reads == 0
+        assert user_ref.writes == [{
+            "subscriptions.prod_pro": firestore.DELETE_FIELD,
+            "authentication.subscribed": firestore.DELETE_FIELD,
+        }]